@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+'''Benchmark the baseline wander estimators of denoise.py against the exact median filters.'''
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import denoise
+import synthetic
+
+def timeit(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+def stream(signal, fs, method, block_s=60):
+    remover = denoise.BaselineWanderRemover(fs, method)
+    block_size = int(block_s * fs)
+    outputs = [ remover.process(signal[i: i+block_size]) for i in range(0, signal.shape[0], block_size) ]
+    outputs.append(remover.flush())
+    return np.concatenate(outputs)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark baseline wander removal.')
+    parser.add_argument('-d', '--durations', help='Signal durations in seconds. (default: 10 600 3600)',
+                        dest='durations', type=float, nargs='+', default=[10, 600, 3600])
+    parser.add_argument('-fs', '--sampling-rate', help='Sampling rate. (default: 1000)',
+                        dest='fs', type=float, default=1000.)
+    args = parser.parse_args()
+
+    print('{:>10} {:>16} {:>10} {:>12} {:>12}'.format('duration', 'method', 'time (s)', 'max error', 'rms error'))
+    for duration_s in args.durations:
+        signal = synthetic.synthetic_signal(0, int(duration_s * args.fs), args.fs, np.random.default_rng(0))
+        reference_time, reference = timeit(denoise.baseline_wander_removal, signal, args.fs, 'exact')
+        print('{:>10.0f} {:>16} {:>10.3f} {:>12} {:>12}'.format(duration_s, 'exact', reference_time, '-', '-'))
+
+        for name, function in [ ('decimate', lambda: denoise.baseline_wander_removal(signal, args.fs, 'decimate')),
+                                ('stream-exact', lambda: stream(signal, args.fs, 'exact')),
+                                ('stream-decimate', lambda: stream(signal, args.fs, 'decimate')) ]:
+            elapsed, result = timeit(function)
+            error = np.abs(result - reference)
+            print('{:>10.0f} {:>16} {:>10.3f} {:>12.3f} {:>12.3f}'.format(duration_s, name, elapsed,
+                                                                            error.max(), np.sqrt(np.mean(error**2))))
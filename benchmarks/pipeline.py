@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+'''Benchmark the stages of the processing pipeline on synthetic recordings.
+
+Every stage runs in a fresh process, so that its peak RSS is its own, and the results
+are written as JSON to compare runs of different versions on the same machine.
+
+    $ python3 benchmarks/pipeline.py -d 10 600 3600 -o before.json
+'''
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import datetime
+import tempfile
+import subprocess
+import multiprocessing
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import synthetic
+import profiling
+
+STAGES = ['get_ekg', 'get_heart_sounds', 'ekg_denoise', 'wavelet_threshold', 'wavelet_threshold_blocks',
+            'generate_spectrogram', 'get_segment']
+
+def synthetic_probabilities(duration_s, fs=1000, seed=0):
+    '''Segmentation probabilities of shape (n_samples, 6) with P, Q, R, S and T bumps at 75 bpm.'''
+    rng = np.random.default_rng(seed)
+    beat = np.zeros((int(0.8 * fs), 6), dtype=np.float32)
+    t = np.arange(beat.shape[0]) / fs
+    for index_peak, center_s in enumerate([0.1, 0.18, 0.2, 0.22, 0.45]): # P, Q, R, S, T
+        beat[:, index_peak] = np.exp(-0.5 * ((t - center_s) / 0.01)**2)
+    beat[:, 5] = 1 - beat[:, :5].sum(axis=1).clip(0, 1) # background
+
+    number_samples = int(duration_s * fs)
+    probabilities = np.tile(beat, (-(-number_samples // beat.shape[0]), 1))[:number_samples]
+    probabilities += rng.uniform(0, 0.01, size=probabilities.shape).astype(np.float32)
+    return probabilities
+
+def _run_stage(stage, bin_filename, raw_filename, duration_s, number_channels_ekg, workers=None):
+    '''Run one stage and return its timing, in a process of its own.
+
+    workers: threads of wavelet_threshold_blocks
+    '''
+    import reader
+    import scipy.signal
+
+    # untimed setup, including the modules imported lazily by the stages
+    reader._import_denoise()
+    if stage in ('ekg_denoise', 'wavelet_threshold', 'wavelet_threshold_blocks'):
+        import denoise
+        data = np.stack([ synthetic.synthetic_signal(0, int(duration_s * 1000), 1000., np.random.default_rng(i))
+                            for i in range(number_channels_ekg) ])
+        data_bytes, data_samples = data.nbytes, data.size
+    elif stage == 'generate_spectrogram':
+        heart_sounds, sampling_rates = reader.get_heart_sounds(raw_filename, verbose=False, use_cache=False)
+        data_bytes = sum(np.asarray(signal).nbytes for signal in heart_sounds)
+        data_samples = sum(len(signal) for signal in heart_sounds)
+        length_s = len(heart_sounds[0]) / sampling_rates[0]
+        # as process_file does
+        time_resolution_s = length_s / reader.SPECTROGRAM_MAX_COLUMNS if length_s > 60 else None
+    elif stage == 'get_segment':
+        import ecgseg
+        probabilities = synthetic_probabilities(duration_s)
+        data_bytes, data_samples = probabilities.nbytes, probabilities.shape[0]
+    setup_rss_mb = profiling.peak_rss_mb()
+
+    start = time.perf_counter()
+    if stage == 'get_ekg':
+        data, _ = reader.get_ekg(bin_filename, use_cache=False)
+        data_bytes, data_samples = os.path.getsize(bin_filename), data.size
+    elif stage == 'get_heart_sounds':
+        heart_sounds, _ = reader.get_heart_sounds(raw_filename, verbose=False, use_cache=False)
+        data_bytes, data_samples = os.path.getsize(raw_filename), sum(len(signal) for signal in heart_sounds)
+    elif stage == 'ekg_denoise':
+        denoise.ekg_denoise(data, 1000)
+    elif stage == 'wavelet_threshold':
+        denoise.wavelet_threshold(data)
+    elif stage == 'wavelet_threshold_blocks':
+        denoise.wavelet_threshold_blocks(data, workers=workers)
+    elif stage == 'generate_spectrogram':
+        reader.generate_spectrogram(heart_sounds, sampling_rates, time_resolution_s=time_resolution_s)
+    elif stage == 'get_segment':
+        ecgseg.get_segment(probabilities)
+    elapsed = time.perf_counter() - start
+
+    return {'time_s': elapsed, 'bytes': int(data_bytes), 'samples': int(data_samples),
+            'setup_rss_mb': setup_rss_mb, 'peak_rss_mb': profiling.peak_rss_mb()}
+
+def run_stage(stage, *args):
+    # a new process per stage, the peak RSS of a process never decreases
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(_run_stage, (stage,) + args)
+
+def _max_rss(values):
+    # None where the peak RSS is not available (Windows)
+    values = [ value for value in values if value is not None ]
+    return max(values) if values else None
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(durations, stages=STAGES, number_channels_ekg=8, number_channels_hs=2,
+                    sampling_rates=(1000, 1000, 500, 500, 250, 250), repeat=1, directory=None, wavelet_workers=None):
+    '''Benchmark the stages on synthetic recordings of every duration and return the results as a dict.
+
+    directory: where the synthetic files are written (default: a temporary directory removed afterwards)
+    wavelet_workers: numbers of threads wavelet_threshold_blocks is run with, to show how it
+        scales with the cores (default: 1, 2, 4, ... up to the number of CPUs)
+    '''
+    if wavelet_workers is None:
+        wavelet_workers = [ 2**i for i in range(int(np.log2(os.cpu_count() or 1)) + 1) ]
+
+    results = list()
+    with tempfile.TemporaryDirectory(dir=directory) as tmp_dirname:
+        for duration_s in durations:
+            bin_filename = os.path.join(tmp_dirname, 'synthetic_{:g}s.bin'.format(duration_s))
+            raw_filename = os.path.join(tmp_dirname, 'synthetic_{:g}s.raw'.format(duration_s))
+            if 'get_ekg' in stages:
+                synthetic.write_bin(bin_filename, duration_s, number_channels_ekg, number_channels_hs)
+            if 'get_heart_sounds' in stages or 'generate_spectrogram' in stages:
+                synthetic.write_raw(raw_filename, duration_s, sampling_rates)
+
+            stage_runs = [ (stage, workers) for stage in stages
+                            for workers in (wavelet_workers if stage == 'wavelet_threshold_blocks' else [None]) ]
+            for stage, workers in stage_runs:
+                runs = [ run_stage(stage, bin_filename, raw_filename, duration_s, number_channels_ekg, workers)
+                            for _ in range(repeat) ]
+                best = min(runs, key=lambda run: run['time_s'])
+                result = {'stage': stage, 'duration_s': duration_s, 'workers': workers,
+                            'time_s': best['time_s'], 'times_s': [ run['time_s'] for run in runs ],
+                            'bytes': best['bytes'], 'samples': best['samples'],
+                            'mb_per_s': best['bytes'] / 2**20 / best['time_s'],
+                            'samples_per_s': best['samples'] / best['time_s'],
+                            'setup_rss_mb': _max_rss(run['setup_rss_mb'] for run in runs),
+                            'peak_rss_mb': _max_rss(run['peak_rss_mb'] for run in runs)}
+                if stage == 'get_ekg': # the header of a *.bin file holds 65535 cycles at most
+                    result['duration_s'] = min(duration_s, synthetic.BIN_MAX_CYCLES / 1000)
+                results.append(result)
+                print('{:>10g} {:>28} {:>10.3f} {:>10.1f} {:>14.3g} {:>10}'.format(
+                        result['duration_s'], stage if workers is None else '{} x{:d}'.format(stage, workers), result['time_s'], result['mb_per_s'], result['samples_per_s'],
+                        '?' if result['peak_rss_mb'] is None else '{:.1f}'.format(result['peak_rss_mb'])), file=sys.stderr)
+
+    return {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'revision': _git_revision(),
+        'machine': {'platform': platform.platform(), 'processor': platform.processor(),
+                    'cpu_count': os.cpu_count(), 'python': platform.python_version(), 'numpy': np.__version__},
+        'config': {'number_channels_ekg': number_channels_ekg, 'number_channels_hs': number_channels_hs,
+                    'sampling_rates': [ float(rate) for rate in sampling_rates ], 'repeat': repeat},
+        'results': results,
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the processing stages on synthetic recordings.')
+    parser.add_argument('-d', '--durations', help='Recording durations in seconds, up to 86400 (24 h). (default: 10 600 3600)',
+                        dest='durations', type=float, nargs='+', default=[10, 600, 3600])
+    parser.add_argument('-s', '--stages', help='Stages to benchmark. (default: all)',
+                        dest='stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('-ne', '--ekg-channels', help='Number of EKG channels. (default: 8)',
+                        dest='ekg_channels', type=int, default=8)
+    parser.add_argument('-nh', '--hs-channels', help='Number of heart sound channels of the *.bin file. (default: 2)',
+                        dest='hs_channels', type=int, default=2)
+    parser.add_argument('-sr', '--sampling-rates', help='Channel sampling rates of the *.raw file. (default: 1000 1000 500 500 250 250)',
+                        dest='sampling_rates', type=float, nargs='+', default=[1000, 1000, 500, 500, 250, 250])
+    parser.add_argument('-ww', '--wavelet-workers', help='Threads of wavelet_threshold_blocks, one run each. (default: 1 2 4 ... up to the number of CPUs)',
+                        dest='wavelet_workers', type=int, nargs='+', default=None)
+    parser.add_argument('-r', '--repeat', help='Runs of each stage, the fastest is reported. (default: 1)',
+                        dest='repeat', type=int, default=1)
+    parser.add_argument('-w', '--work-dir', help='Directory of the temporary synthetic files. (default: system temporary directory)',
+                        dest='work_dir', default=None)
+    parser.add_argument('-o', '--output', help='JSON file of the results. (default: stdout)',
+                        dest='output', default=None)
+    args = parser.parse_args()
+
+    print('{:>10} {:>28} {:>10} {:>10} {:>14} {:>10}'.format('duration', 'stage', 'time (s)', 'MB/s', 'samples/s', 'RSS (MB)'),
+            file=sys.stderr)
+    report = run_benchmarks(args.durations, args.stages, args.ekg_channels, args.hs_channels,
+                            args.sampling_rates, args.repeat, args.work_dir, args.wavelet_workers)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        print(json.dumps(report, indent=1))
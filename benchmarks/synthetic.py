@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+'''Writers of synthetic Audicor *.bin and *.raw files, following the header layouts parsed by reader.py.
+
+The samples are written a block at a time, so that recordings of any duration can be
+generated in bounded memory.
+
+    $ python3 benchmarks/synthetic.py test.raw -d 3600 -sr 1000 1000 500 500 250 250
+'''
+import argparse
+import numpy as np
+
+BIN_DATA_OFFSET = 0x4B8
+RAW_DATA_OFFSET = 0x200
+
+# the number of cycles of a *.bin file is stored in 2 bytes
+BIN_MAX_CYCLES = 0xFFFF
+
+def synthetic_signal(start_index, length, fs, rng, amplitude=800):
+    '''Beats at 75 bpm on top of a slow baseline wander and white noise, from sample start_index on.'''
+    index = np.arange(start_index, start_index + length)
+    t = index / fs
+    wander = 0.4 * amplitude * np.sin(2 * np.pi * 0.3 * t) + 0.1 * amplitude * np.sin(2 * np.pi * 0.05 * t)
+    beats = amplitude * ((index % int(0.8 * fs)) < max(1, int(0.02 * fs)))
+    return wander + beats + 0.06 * amplitude * rng.standard_normal(length)
+
+def write_bin(filename, duration_s, number_channels_ekg=8, number_channels_hs=2, block_s=60, seed=0):
+    '''Write a *.bin EKG file of int16 samples at 1000 Hz and return its number of cycles.
+
+    The duration is capped to BIN_MAX_CYCLES cycles, the most the header can hold.
+    '''
+    number_channels = number_channels_ekg + number_channels_hs
+    data_length = min(int(duration_s * 1000), BIN_MAX_CYCLES)
+    rng = np.random.default_rng(seed)
+
+    header = bytearray(BIN_DATA_OFFSET)
+    header[0xE0:0xE2] = number_channels_ekg.to_bytes(2, byteorder='little')
+    header[0xE4:0xE6] = number_channels_hs.to_bytes(2, byteorder='little')
+    header[0xE8:0xEA] = data_length.to_bytes(2, byteorder='little')
+
+    block_size = int(block_s * 1000)
+    with open(filename, 'wb') as f:
+        f.write(header)
+        for start in range(0, data_length, block_size):
+            length = min(block_size, data_length - start)
+            block = np.empty((length, number_channels), dtype='<i2') # interleaved as [cycle, channel]
+            for index_channel in range(number_channels):
+                block[:, index_channel] = synthetic_signal(start, length, 1000., rng)
+            f.write(block.tobytes())
+    return data_length
+
+def _rate_field(rate):
+    return '{:<15}'.format(repr(float(rate))).encode('utf-8') + b'\x00'
+
+def raw_index_order(main_sampling_rate, sampling_rates):
+    '''Order of the channels of the values of one interleave cycle of a *.raw file.'''
+    if any(main_sampling_rate % rate for rate in sampling_rates):
+        raise ValueError('the sampling rates must divide the main sampling rate, got {} and {}'.format(
+                            sampling_rates, main_sampling_rate))
+    if sampling_rates[-1] != min(sampling_rates):
+        raise ValueError('the last channel must have the lowest sampling rate, got {}'.format(sampling_rates))
+
+    index_order = list()
+    for cycle in range(int(main_sampling_rate // sampling_rates[-1])):
+        for index_channel, rate in enumerate(sampling_rates):
+            if cycle % (main_sampling_rate // rate) == 0:
+                index_order.append(index_channel)
+    return index_order
+
+def write_raw(filename, duration_s, sampling_rates=(1000, 1000, 500, 500, 250, 250), main_sampling_rate=None,
+                block_s=60, seed=0):
+    '''Write a *.raw heart sound file of uint16 samples and return its number of interleave cycles.
+
+    main_sampling_rate: rate of the interleave clock (default: the highest channel rate)
+    '''
+    sampling_rates = [ float(rate) for rate in sampling_rates ]
+    main_sampling_rate = float(max(sampling_rates) if main_sampling_rate is None else main_sampling_rate)
+    index_order = raw_index_order(main_sampling_rate, sampling_rates)
+    rng = np.random.default_rng(seed)
+
+    header = bytearray(0x24) + bytes([len(sampling_rates)]) + b'\x00\x0F' + _rate_field(main_sampling_rate)
+    for rate in sampling_rates:
+        header += _rate_field(rate)
+    if len(header) > RAW_DATA_OFFSET:
+        raise ValueError('too many channels for the header, got {}'.format(len(sampling_rates)))
+    header += bytes(RAW_DATA_OFFSET - len(header))
+
+    # values of each channel in one cycle, and their positions in the cycle
+    positions = [ [ i for i, index_channel in enumerate(index_order) if index_channel == c ]
+                    for c in range(len(sampling_rates)) ]
+    cycle_s = index_order.count(0) / sampling_rates[0]
+    number_cycles = int(duration_s / cycle_s)
+    block_cycles = max(1, int(block_s / cycle_s))
+
+    with open(filename, 'wb') as f:
+        f.write(bytes(header))
+        for start in range(0, number_cycles, block_cycles):
+            length = min(block_cycles, number_cycles - start)
+            block = np.empty((length, len(index_order)), dtype='<u2')
+            for index_channel, position in enumerate(positions):
+                signal = synthetic_signal(start * len(position), length * len(position), sampling_rates[index_channel], rng)
+                block[:, position] = np.clip(signal + 32768, 0, 65535).reshape(length, len(position))
+            f.write(block.tobytes())
+    return number_cycles
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic Audicor *.bin or *.raw file.')
+    parser.add_argument('filename', help='*.bin or *.raw file to write.')
+    parser.add_argument('-d', '--duration', help='Duration in seconds. (default: 10)',
+                        dest='duration', type=float, default=10.)
+    parser.add_argument('-ne', '--ekg-channels', help='Number of EKG channels of a *.bin file. (default: 8)',
+                        dest='ekg_channels', type=int, default=8)
+    parser.add_argument('-nh', '--hs-channels', help='Number of heart sound channels of a *.bin file. (default: 2)',
+                        dest='hs_channels', type=int, default=2)
+    parser.add_argument('-sr', '--sampling-rates', help='Channel sampling rates of a *.raw file. (default: 1000 1000 500 500 250 250)',
+                        dest='sampling_rates', type=float, nargs='+', default=[1000, 1000, 500, 500, 250, 250])
+    args = parser.parse_args()
+
+    if args.filename.lower().endswith('.bin'):
+        print('{} cycles written.'.format(write_bin(args.filename, args.duration, args.ekg_channels, args.hs_channels)))
+    elif args.filename.lower().endswith('.raw'):
+        print('{} cycles written.'.format(write_raw(args.filename, args.duration, args.sampling_rates)))
+    else:
+        parser.error('filename must be *.bin or *.raw')
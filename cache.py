@@ -0,0 +1,100 @@
+'''Columnar cache of decoded recordings.
+
+A recording `some/file.raw` is cached in the directory `some/file.raw.cache` as one
+`channel_<i>.npy` per channel in its native dtype, plus a `header.json` holding the
+recording info and the size and modification time of the source file. The header is
+written last, so a cache is only used once it is complete and as long as the source
+file is unchanged. Arrays derived from the recording (e.g. plotting pyramids) can be
+stored in the same directory as `<name>.npz`.
+'''
+import os
+import json
+import numpy as np
+
+CACHE_VERSION = 1
+
+def cache_dirname(filename):
+    return filename + '.cache'
+
+def _header_filename(filename):
+    return os.path.join(cache_dirname(filename), 'header.json')
+
+def _channel_filename(filename, index_channel):
+    return os.path.join(cache_dirname(filename), 'channel_{:d}.npy'.format(index_channel))
+
+def _extra_filename(filename, name):
+    return os.path.join(cache_dirname(filename), name + '.npz')
+
+def _source_stat(filename):
+    stat = os.stat(filename)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def read_header(filename):
+    '''Return the cached header of filename, or None if there is no fresh cache.'''
+    try:
+        with open(_header_filename(filename), 'r') as f:
+            header = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if header.get('version') != CACHE_VERSION or header.get('source') != _source_stat(filename):
+        return None
+    return header
+
+def load_channels(filename, channels):
+    '''Memory-map the cached channels of filename, read-only.'''
+    return [ np.load(_channel_filename(filename, i), mmap_mode='r') for i in channels ]
+
+def create_channels(filename, channel_lengths, dtype):
+    '''Create the (writable, memory-mapped) channel files of a new cache and return them.
+
+    Any previous cache of filename is invalidated first, along with its extra arrays.
+    '''
+    os.makedirs(cache_dirname(filename), exist_ok=True)
+    if os.path.exists(_header_filename(filename)):
+        os.remove(_header_filename(filename))
+    for name in os.listdir(cache_dirname(filename)):
+        if name.endswith('.npz'):
+            os.remove(os.path.join(cache_dirname(filename), name))
+
+    return [ np.lib.format.open_memmap(_channel_filename(filename, index_channel), mode='w+',
+                                        dtype=dtype, shape=(length,))
+                for index_channel, length in enumerate(channel_lengths) ]
+
+def commit(filename, channel_arrays, **info):
+    '''Flush the channel files and write the header, which makes the cache valid.
+
+    info: JSON-serializable recording info, e.g. sampling rates and duration
+    '''
+    for array in channel_arrays:
+        array.flush()
+
+    header = dict(info)
+    header['version'] = CACHE_VERSION
+    header['source'] = _source_stat(filename)
+    header['dtype'] = np.dtype(channel_arrays[0].dtype).str if channel_arrays else None
+    header['channel_lengths'] = [ int(array.shape[0]) for array in channel_arrays ]
+
+    tmp_filename = _header_filename(filename) + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump(header, f, indent=1)
+    os.replace(tmp_filename, _header_filename(filename))
+    return header
+
+def save_extra(filename, name, arrays):
+    '''Store derived arrays (e.g. a plotting pyramid) in the cache of filename.
+
+    Nothing is stored and False is returned if filename has no fresh cache.
+    '''
+    if read_header(filename) is None:
+        return False
+    tmp_filename = _extra_filename(filename, name) + '.tmp.npz'
+    np.savez(tmp_filename, **arrays)
+    os.replace(tmp_filename, _extra_filename(filename, name))
+    return True
+
+def load_extra(filename, name):
+    '''Load the derived arrays stored by save_extra, or None if they are missing or stale.'''
+    if read_header(filename) is None or not os.path.exists(_extra_filename(filename, name)):
+        return None
+    return np.load(_extra_filename(filename, name))
@@ -1,81 +1,395 @@
 import numpy as np
 import pywt
-from scipy.ndimage.filters import median_filter
+from scipy.ndimage import median_filter
 
+import atexit
+import functools
 import multiprocessing as mp
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
-from scipy.signal import butter, sosfiltfilt
+from scipy.signal import butter, sosfilt, sosfilt_zi, sosfiltfilt
 
-def wavelet_threshold(data, wavelet='sym8', noiseSigma=14):
-    levels = int(np.floor(np.log2(data.shape[0])))
-    WC = pywt.wavedec(data,wavelet,level=levels)
-    threshold=noiseSigma*np.sqrt(2*np.log2(data.size))
+# the most processes or threads a denoising call uses, None for the number of CPUs
+_max_workers = None
+
+def get_max_workers():
+    return mp.cpu_count() if _max_workers is None else _max_workers
+
+def set_max_workers(max_workers):
+    '''Limit the processes and threads used by this module, e.g. to share the CPUs with other
+    processes denoising at the same time (None for the number of CPUs).'''
+    global _max_workers, _process_pool
+    _max_workers = max_workers
+    if _process_pool is not None: # started again with the new size when needed
+        _process_pool.shutdown()
+        _process_pool = None
+
+def _soft_threshold(data, wavelet, levels, threshold):
+    WC = pywt.wavedec(data,wavelet,level=levels,axis=-1)
     NWC = list(map(lambda x: pywt.threshold(x,threshold, mode='soft'), WC))
-    return pywt.waverec(NWC, wavelet)
+    return pywt.waverec(NWC, wavelet, axis=-1)[..., :data.shape[-1]]
+
+def wavelet_threshold(data, wavelet='sym8', noiseSigma=14):
+    '''Wavelet thresholding along the last axis, so several channels can be processed at once.'''
+    levels = int(np.floor(np.log2(data.shape[-1])))
+    threshold=noiseSigma*np.sqrt(2*np.log2(data.shape[-1]))
+    return _soft_threshold(data, wavelet, levels, threshold)
+
+def wavelet_threshold_blocks(data, wavelet='sym8', noiseSigma=14, block_size=2**16, overlap=2**12, levels=None, workers=None):
+    '''Wavelet thresholding along the last axis of a long signal, in overlapping blocks.
+
+    Every block is decomposed to at most `levels` levels (default: the maximum useful level
+    of a block) and consecutive blocks are crossfaded linearly over their `overlap` samples.
+    The threshold is the one wavelet_threshold would use on the whole signal. Blocks are
+    processed by `workers` threads (default: get_max_workers()), a few at a time, so the memory
+    used besides the output does not depend on the signal length. pywt releases the GIL in its
+    transforms, so the threads run on several cores (see the wavelet_threshold_blocks stage of
+    benchmarks/pipeline.py).
+
+    The result only approximates wavelet_threshold: the coarsest levels are not decomposed and
+    the crossfades blend two estimates. On a synthetic EKG of std 270 (20M samples) the two
+    differ by about 1.2 RMS and up to about 9.
+    '''
+    n = data.shape[-1]
+    if not 0 < overlap < block_size:
+        raise ValueError('overlap must be in (0, block_size), got {} with block_size={}'.format(overlap, block_size))
+    if n <= block_size:
+        return wavelet_threshold(data, wavelet, noiseSigma)
+
+    levels = pywt.dwt_max_level(block_size, wavelet) if levels is None else levels
+    threshold=noiseSigma*np.sqrt(2*np.log2(n))
+    workers = get_max_workers() if workers is None else workers
+
+    # every block but the last one is block_size long, and the last one ends at n
+    step = block_size - overlap
+    block_starts = list(range(0, n - overlap, step))
+    fade_in = (np.arange(overlap) + 0.5) / overlap
+
+    def denoise_block(index_block):
+        start = block_starts[index_block]
+        block = _soft_threshold(data[..., start: start+block_size], wavelet, levels, threshold)
+        if index_block > 0:
+            block[..., :overlap] *= fade_in
+        if index_block < len(block_starts) - 1:
+            block[..., -overlap:] *= fade_in[::-1]
+        return start, block
+
+    result = np.zeros(data.shape, dtype=np.float64)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for wave_start in range(0, len(block_starts), 2 * workers):
+            wave = range(wave_start, min(len(block_starts), wave_start + 2 * workers))
+            for start, block in executor.map(denoise_block, wave):
+                result[..., start: start+block.shape[-1]] += block
+    return result
+
+# with more samples than this, the wavelet thresholding of ekg_denoise is done block by block
+WAVELET_BLOCKS_MIN_SAMPLES = 2**20
+
+def _to_odd(x):
+    x = int(x)
+    return x if x % 2 == 1 else x + 1
+
+def _baseline_windows(fs):
+    # the two median windows: 0.2s then 0.6s
+    return _to_odd(fs*0.2), _to_odd(fs*0.6)
+
+def _decimation_factor(fs):
+    # about 10 decimated samples per window of the first median filter
+    return max(1, int(fs*0.2) // 10)
+
+# with more samples than this, the 'auto' method (opt-in) estimates the baseline on a decimated signal
+DECIMATE_BASELINE_MIN_SAMPLES = 1000000
+
+def _exact_baseline(data, fs):
+    window_1, window_2 = _baseline_windows(fs)
+    baseline = median_filter(data, window_1, mode='constant')
+    return median_filter(baseline, window_2, mode='constant')
+
+def _decimated_baseline(data, fs):
+    '''Approximate the two median filters on the medians of blocks of samples, then interpolate back.'''
+    window_1, window_2 = _baseline_windows(fs)
+    q = _decimation_factor(fs)
+
+    number_full = data.shape[0] // q * q
+    block_medians = np.median(data[:number_full].reshape(-1, q), axis=1)
+    block_centers = np.arange(block_medians.shape[0]) * q + (q - 1) / 2
+    if number_full < data.shape[0]: # the last block is shorter
+        block_medians = np.append(block_medians, np.median(data[number_full:]))
+        block_centers = np.append(block_centers, (number_full + data.shape[0] - 1) / 2)
+
+    baseline = median_filter(block_medians, _to_odd(window_1 / q), mode='constant')
+    baseline = median_filter(baseline, _to_odd(window_2 / q), mode='constant')
+    return np.interp(np.arange(data.shape[0]), block_centers, baseline)
+
+BASELINE_METHODS = {
+    'exact': _exact_baseline,
+    'decimate': _decimated_baseline,
+}
+
+def estimate_baseline(data, fs, method='exact'):
+    '''Estimate the baseline wander along the last axis with two median filters.
+
+    method: 'exact', 'decimate' (decimate -> median -> interpolate, much faster on long signals),
+        or 'auto' to use 'decimate' for signals longer than DECIMATE_BASELINE_MIN_SAMPLES.
+        'decimate' only approximates 'exact': on a synthetic EKG of std 270 at 1 kHz (see
+        benchmarks/baseline.py) the baseline differs by about 6 RMS and up to about 35.
+    '''
+    if data.ndim > 1: # the 1-D median filter is much faster than the n-D one, go channel by channel
+        channels = data.reshape(-1, data.shape[-1])
+        return np.array([ estimate_baseline(channel, fs, method) for channel in channels ]).reshape(data.shape)
+
+    if method == 'auto':
+        method = 'decimate' if data.shape[0] > DECIMATE_BASELINE_MIN_SAMPLES else 'exact'
+    if method not in BASELINE_METHODS:
+        raise ValueError('method must be one of {}, got {}'.format(['auto'] + list(BASELINE_METHODS), method))
+    return BASELINE_METHODS[method](data, fs)
+
+def baseline_wander_removal(data, fs, method='exact'):
+    '''Remove the baseline along the last axis, see estimate_baseline for the methods.'''
+    return data - estimate_baseline(data, fs, method)
+
+class BaselineWanderRemover:
+    '''Streaming baseline wander removal, for signals fed block by block.
+
+    Each output sample needs the input samples half a window of each median filter
+    ahead, so process() returns the samples which are fully determined so far and
+    flush() the remaining ones once the signal ends. The concatenated outputs equal
+    baseline_wander_removal(whole signal, fs, method).
+    '''
+    def __init__(self, fs, method='exact'):
+        if method not in BASELINE_METHODS:
+            raise ValueError('method must be one of {}, got {}'.format(list(BASELINE_METHODS), method))
+        self.fs, self.method = fs, method
+
+        window_1, window_2 = _baseline_windows(fs)
+        q = _decimation_factor(fs) if method == 'decimate' else 1
+        self.context = window_1 // 2 + window_2 // 2 + 2 * q
+        if method == 'decimate': # the decimated medians also look one window around
+            self.context += (_to_odd(window_1 / q) // 2 + _to_odd(window_2 / q) // 2) * q
+        self.q = q
 
-def baseline_wander_removal(data, fs):
-    def to_odd(x):
-        x = int(x)
-        return x if x % 2 == 1 else x + 1
+        self.buffer = np.zeros(0)
+        self.buffer_start = 0 # index of buffer[0] in the whole signal
+        self.number_emitted = 0
 
-    baseline = median_filter(data, to_odd(fs*0.2), mode='constant')
-    baseline = median_filter(baseline, to_odd(fs*0.6), mode='constant')
-    return data - baseline
+    def _emit(self, end_index):
+        '''Return the outputs from number_emitted to end_index, and drop the context not needed anymore.'''
+        if end_index <= self.number_emitted:
+            return np.zeros(0)
 
-def _denoise_mp(signal, fs):
-    return baseline_wander_removal(wavelet_threshold(signal), fs)
+        # the ends of the buffer are zero padded as if the signal stopped there, they are only
+        # emitted at the true start and the end of the signal
+        baseline = estimate_baseline(self.buffer, self.fs, self.method)
+        begin, end = self.number_emitted - self.buffer_start, end_index - self.buffer_start
+        output = self.buffer[begin:end] - baseline[begin:end]
+        self.number_emitted = end_index
+
+        # keep enough samples before the next output, aligned to the decimation blocks
+        new_start = max(0, (self.number_emitted - self.context) // self.q * self.q)
+        self.buffer = self.buffer[new_start - self.buffer_start:]
+        self.buffer_start = new_start
+        return output
+
+    def process(self, block):
+        self.buffer = np.concatenate([self.buffer, np.asarray(block, dtype=np.float64)])
+        return self._emit(self.buffer_start + self.buffer.shape[0] - self.context)
+
+    def flush(self):
+        return self._emit(self.buffer_start + self.buffer.shape[0])
+
+def _denoise_channels(signals, fs, progress=None):
+    if signals.shape[-1] > WAVELET_BLOCKS_MIN_SAMPLES:
+        result = baseline_wander_removal(wavelet_threshold_blocks(signals), fs)
+    else:
+        result = baseline_wander_removal(wavelet_threshold(signals), fs)
+    if progress is not None:
+        progress(signals.size, signals.size)
+    return result
+
+# a long-lived process pool shared by every call with the 'process' backend
+_process_pool = None
+
+def _get_process_pool():
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=get_max_workers())
+        atexit.register(_process_pool.shutdown)
+    return _process_pool
+
+def _denoise_shared(shm_name, shape, index_channel, fs):
+    '''Denoise one channel of a [n_channels, n_samples] float64 array in shared memory, in place.'''
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        signals = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+        signals[index_channel] = _denoise_channels(signals[index_channel], fs)
+        del signals
+    finally:
+        shm.close()
+
+def _denoise_processes(signals, fs, progress=None):
+    shm = shared_memory.SharedMemory(create=True, size=max(1, signals.size * 8))
+    try:
+        shared = np.ndarray(signals.shape, dtype=np.float64, buffer=shm.buf)
+        shared[:] = signals
+        workers = _get_process_pool()
+        futures = [ workers.submit(_denoise_shared, shm.name, signals.shape, i, fs) for i in range(signals.shape[0]) ]
+        for number_done, future in enumerate(as_completed(futures), 1):
+            future.result()
+            if progress is not None:
+                progress(number_done * signals.shape[1], signals.size)
+        result = shared.copy()
+        del shared
+    finally:
+        shm.close()
+        shm.unlink()
+    return result
+
+def _denoise_threads(signals, fs, progress=None):
+    result = np.empty_like(signals)
+    with ThreadPoolExecutor(max_workers=min(signals.shape[0], get_max_workers())) as workers:
+        futures = { workers.submit(_denoise_channels, signal, fs): i for i, signal in enumerate(signals) }
+        for number_done, future in enumerate(as_completed(futures), 1):
+            result[futures[future]] = future.result()
+            if progress is not None:
+                progress(number_done * signals.shape[1], signals.size)
+    return result
+
+DENOISE_BACKENDS = {
+    'vectorized': _denoise_channels,
+    'thread': _denoise_threads,
+    'process': _denoise_processes,
+}
+
+# with fewer samples than this, starting work in other processes costs more than it saves
+PROCESS_BACKEND_MIN_SAMPLES = 2000000
+
+def _select_backend(signals):
+    if signals.size >= PROCESS_BACKEND_MIN_SAMPLES and signals.shape[0] > 1 and get_max_workers() > 1:
+        return 'process'
+    return 'vectorized'
 
 def denoise(*args, **kwargs):
     import warnings
     warnings.warn('The denoise.denoise function is deprecated, use denoise.ekg_denoise instead!', UserWarning)
     return ekg_denoise(*args, **kwargs)
 
-def ekg_denoise(data, fs, number_channels=None):
+def ekg_denoise(data, fs, number_channels=None, backend='auto', progress=None):
     '''Denoise the ekg data parallely and return.
     
     data: np.ndarray of shape [n_channels, n_samples]
     fs: sampling rate of data
     number_channels: the first N channels to be processed
+    backend: 'vectorized' (all channels at once in this process), 'thread', 'process'
+        (a long-lived process pool working on shared memory), or 'auto' to pick by signal size
+    progress: called as progress(samples denoised, total samples), once per channel done
+        with the 'thread' and 'process' backends, at the end with 'vectorized'
     '''
 
     number_channels = data.shape[0] if number_channels is None else number_channels
+    signals = np.asarray(data[:number_channels], dtype=np.float64)
+    if signals.size == 0:
+        return data
 
-    with mp.Pool(processes=number_channels) as workers:
-        results = list()
-
-        for i in range(number_channels):
-            results.append(workers.apply_async(_denoise_mp, (data[i], fs)))
+    if backend == 'auto':
+        backend = _select_backend(signals)
+    if backend not in DENOISE_BACKENDS:
+        raise ValueError('backend must be one of {}, got {}'.format(['auto'] + list(DENOISE_BACKENDS), backend))
 
-        workers.close()
-        workers.join()
-
-        for i, result in enumerate(results):
-            data[i] = result.get()
+    result = DENOISE_BACKENDS[backend](signals, fs, progress)
+    for i in range(number_channels):
+        data[i] = result[i]
 
     return data
 
+@functools.lru_cache(maxsize=None)
+def butter_bandpass_sos(lowcut, highcut, fs, order=5):
+    '''Design (once per set of arguments) a Butterworth band pass filter as second-order sections.'''
+    nyq = 0.5 * fs
+    low = lowcut / nyq
+    high = highcut / nyq
+    return butter(order, [low, high], analog=False, btype='band', output='sos')
+
 def butter_bandpass_filter(data, lowcut, highcut, fs, order=5):
     '''Butter bandpass filter
 
     source: https://stackoverflow.com/questions/12093594/how-to-implement-band-pass-butterworth-filter-with-scipy-signal-butter
 
     args:
-        data: np.array of shape [n_samples]
+        data: np.array of shape [n_samples], or [n_channels, n_samples] to filter every channel at once
     '''
-    nyq = 0.5 * fs
-    low = lowcut / nyq
-    high = highcut / nyq
-
-    sos = butter(order, [low, high], analog=False, btype='band', output='sos')
-    y = sosfiltfilt(sos, data)
+    sos = butter_bandpass_sos(lowcut, highcut, fs, order)
+    y = sosfiltfilt(sos, data, axis=-1)
     return y
 
-def heart_sound_denoise(data, lowcut, highcut, fs, order=5):
+def heart_sound_denoise(data, lowcut, highcut, fs, order=5, progress=None):
     '''Denoise heart sound signal with band pass filters and return.
 
     args:
         data: np.ndarray of shape [n_channels, n_samples]
+        progress: called as progress(samples filtered, total samples)
+    '''
+    if data.dtype == object: # channels of different lengths
+        total_samples = sum(len(signal) for signal in data)
+        done_samples = 0
+        for index_channel in range(data.shape[0]):
+            data[index_channel] = butter_bandpass_filter(data[index_channel], lowcut, highcut, fs, order)
+            done_samples += len(data[index_channel])
+            if progress is not None:
+                progress(done_samples, total_samples)
+    elif data.size:
+        data[:] = butter_bandpass_filter(data, lowcut, highcut, fs, order)
+        if progress is not None:
+            progress(data.size, data.size)
+    return data
+
+class StreamingBandpassFilter:
+    '''Butterworth band pass filter for signals fed block by block, along the last axis.
+
+    By default the filter is causal and keeps its state (zi) across blocks, so process()
+    returns as many samples as it is given. With zero_phase=True, every block is filtered
+    forward and backward together with `overlap` samples before and after it (default: ten
+    periods of lowcut), so the output lags by `overlap` samples and flush() returns the end.
+    The concatenated outputs then match butter_bandpass_filter on the whole signal, except for
+    the small part of the impulse response longer than `overlap`.
     '''
-    for index_channel in range(data.shape[0]):
-        data[index_channel] = butter_bandpass_filter(data[index_channel], lowcut, highcut, fs, order)
-    return data
\ No newline at end of file
+    def __init__(self, lowcut, highcut, fs, order=5, zero_phase=False, overlap=None):
+        self.sos = butter_bandpass_sos(lowcut, highcut, fs, order)
+        self.zero_phase = zero_phase
+        self.overlap = int(10 * fs / lowcut) if overlap is None else int(overlap)
+
+        self.zi = None # causal filter state
+        self.buffer = None # zero phase input not emitted yet, with its context
+        self.buffer_start = 0
+        self.number_emitted = 0
+
+    def process(self, block):
+        block = np.asarray(block, dtype=np.float64)
+        if not self.zero_phase:
+            if self.zi is None: # start in the steady state of the first sample
+                zi = sosfilt_zi(self.sos)
+                self.zi = zi.reshape((zi.shape[0],) + (1,) * (block.ndim - 1) + (2,)) * block[..., :1]
+            output, self.zi = sosfilt(self.sos, block, axis=-1, zi=self.zi)
+            return output
+
+        self.buffer = block if self.buffer is None else np.concatenate([self.buffer, block], axis=-1)
+        return self._emit(self.buffer_start + self.buffer.shape[-1] - self.overlap)
+
+    def flush(self):
+        if not self.zero_phase or self.buffer is None:
+            return np.zeros(0)
+        return self._emit(self.buffer_start + self.buffer.shape[-1])
+
+    def _emit(self, end_index):
+        if end_index <= self.number_emitted:
+            return self.buffer[..., :0]
+
+        output = sosfiltfilt(self.sos, self.buffer, axis=-1)
+        output = output[..., self.number_emitted - self.buffer_start: end_index - self.buffer_start]
+        self.number_emitted = end_index
+
+        # keep the context of the next output
+        new_start = max(0, self.number_emitted - self.overlap)
+        self.buffer = self.buffer[..., new_start - self.buffer_start:]
+        self.buffer_start = new_start
+        return output
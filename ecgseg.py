@@ -1,6 +1,8 @@
 import numpy as np
-from keras.models import load_model
+from scipy.ndimage import maximum_filter1d
 import pickle
+import time
+import itertools
 import reader
 
 # use CPU only
@@ -21,50 +23,164 @@ def normalize(X, means_and_stds=None):
         normalized_X[..., i] = normalized_X[..., i] / stds[i]
     return normalized_X, (means, stds)
 
-def get_segment(probabilities): # (10000, 6)
-    diff = np.swapaxes(np.diff(probabilities, axis=0), 0, 1) # (6, 10000-1) p,q,r,s,t
-    probabilities = np.swapaxes(probabilities, 0, 1) # (6, 10000)
-    peak_indices = [[] for _ in range(5)]
+def get_peaks(probabilities, half_window=300):
+    '''Return the indices of the P, Q, R, S and T peaks of probabilities of shape (n_samples, 6).
 
+    A peak is a local maximum above mean + 3 * std of its class, which is also the maximum
+    of the `half_window` samples around it.
+    '''
+    peak_indices = list()
     for index_peak in range(5): # p,q,r,s,t
-        peak_threshold = probabilities[index_peak].mean() + 3 * probabilities[index_peak].std()
+        probability = probabilities[:, index_peak]
+        peak_threshold = probability.mean() + 3 * probability.std()
+
+        diff = np.diff(probability)
+        local_peaks = np.logical_and( (diff>=0)[:-1], (diff<=0)[1:] ) # (n_samples - 2)
+        local_peaks = np.logical_and( local_peaks, (probability > peak_threshold)[1:-1] )
+
+        # the maximum of [i-half_window, i+half_window), the last sample excluded
+        local_maximum = maximum_filter1d(probability[:-1], size=2*half_window, mode='constant', cval=-np.inf)
+        local_peaks = np.logical_and( local_peaks, (probability[1:-1] == local_maximum[1:]) )
+        peak_indices.append(np.flatnonzero(local_peaks) + 2)
+    return peak_indices
 
-        local_peaks = np.logical_and( (diff[index_peak]>=0)[:-1], (diff[index_peak]<=0)[1:] ) # (10000 - 2)
-        local_peaks = np.logical_and( local_peaks, (probabilities[index_peak] > peak_threshold)[1:-1] )
+def get_segment(probabilities): # (10000, 6)
+    '''Return the peak indices (a list of 5 int arrays: P, Q, R, S, T) and the segment boundaries.
 
-        for location_peak in np.where(local_peaks)[0] + 1:
-            local_maximum = probabilities[index_peak, max(0, location_peak-300):min(9999, location_peak+300)].max()
-            if probabilities[index_peak, location_peak] == local_maximum:
-                peak_indices[index_peak].append(location_peak+1)
+    A segment boundary is the middle between a T peak and the following P peak.
+    '''
+    peak_indices = get_peaks(probabilities)
 
     P, Q, R, S, T = 0, 1, 2, 3, 4
-    # T start
-    segment_indices = list()
-    if peak_indices[P][0] > peak_indices[T][0]:
-        for i in range(len(peak_indices[P])):
-            segment_indices.append( (peak_indices[P][i] + peak_indices[T][i])//2 )
-    else: # P start
-        for i in range(len(peak_indices[P])-1):
-            segment_indices.append( (peak_indices[P][i+1] + peak_indices[T][i])//2 )
+    next_p = np.searchsorted(peak_indices[P], peak_indices[T], side='right')
+    valid = next_p < len(peak_indices[P])
+    t_peaks, next_p = peak_indices[T][valid], next_p[valid]
+
+    # several T peaks before the same P peak: keep the closest one
+    closest = np.ones(len(next_p), dtype=bool)
+    closest[:-1] = next_p[1:] != next_p[:-1]
+    segment_indices = (peak_indices[P][next_p[closest]] + t_peaks[closest]) // 2
 
     return peak_indices, segment_indices
 
-def predict(model_filename, ekg_signal):
-    # load model
-    model = load_model(model_filename, compile=False)
+class Segmenter:
+    '''Segment 10-second 8-lead EKGs with a model loaded once.
+
+    args:
+        model_filename: keras model to load
+        means_and_stds_filename: pickled normalization statistics of the model inputs
+        batch_size: number of records per model.predict batch
+        number_threads: threads used by tensorflow (default: tensorflow's choice), only effective
+            if set before tensorflow runs anything in this process, a warning is issued otherwise
+    '''
+    def __init__(self, model_filename, means_and_stds_filename='./seg_means_and_stds.pickle', batch_size=64, number_threads=None):
+        if number_threads:
+            import tensorflow as tf
+            try:
+                tf.config.threading.set_intra_op_parallelism_threads(number_threads)
+                tf.config.threading.set_inter_op_parallelism_threads(number_threads)
+            except RuntimeError: # tensorflow is already initialized
+                import warnings
+                warnings.warn('number_threads={} is ignored, tensorflow already runs with {} intra-op threads.'.format(
+                                number_threads, tf.config.threading.get_intra_op_parallelism_threads()), RuntimeWarning)
+
+        from keras.models import load_model # tensorflow takes seconds to import, only do it when needed
+        self.model = load_model(model_filename, compile=False)
+        with open(means_and_stds_filename, 'rb') as f:
+            self.means_and_stds = pickle.load(f)
+        self.batch_size = batch_size
+
+        # for throughput
+        self.number_records, self.elapsed_time = 0, 0.
+
+    @staticmethod
+    def preprocess(ekg_signal):
+        return np.swapaxes(ekg_signal[:8], 0, 1) # (8, 10000) -> (10000, 8)
+
+    def predict_probabilities(self, ekg_signals):
+        '''Return the probabilities of shape (n_records, 10000, 6) of a sequence of (8+, 10000) EKGs,
+        all predicted at once (see predict_many for many EKGs).'''
+        start_time = time.perf_counter()
+        X = np.stack([ self.preprocess(ekg_signal) for ekg_signal in ekg_signals ])
+        X, _ = normalize(X, self.means_and_stds)
+        probabilities = self.model.predict(X, batch_size=self.batch_size, verbose=0)
+
+        self.number_records += X.shape[0]
+        self.elapsed_time += time.perf_counter() - start_time
+        return probabilities
 
-    # normalize signal
-    with open('./seg_means_and_stds.pickle', 'rb') as f:
-        means_and_stds = pickle.load(f)
-    ekg_signal = np.swapaxes(ekg_signal[:8], 0, 1) # (8, 10000) -> (10000, 8)
-    ekg_signal = ekg_signal.reshape(1, 10000, 8)
-    ekg_signal, _ = normalize(ekg_signal, means_and_stds)
+    def predict_many(self, ekg_signals):
+        '''Return a list of (peak_indices, segment_indices), one per EKG of the iterable ekg_signals.
 
-    # do prediction
-    probabilities = model.predict(ekg_signal)[0]
-    return get_segment(probabilities) # post processing
+        The EKGs are predicted batch_size at a time, so the memory used does not grow with their number.
+        '''
+        results = list()
+        ekg_signals = iter(ekg_signals)
+        while True:
+            batch = list(itertools.islice(ekg_signals, self.batch_size))
+            if not batch:
+                return results
+            results += [ get_segment(probabilities) for probabilities in self.predict_probabilities(batch) ]
+
+    def predict(self, ekg_signal):
+        return self.predict_many([ekg_signal])[0]
+
+    def predict_probabilities_long(self, ekg_signal, window=10000, overlap=1000):
+        '''Return the probabilities of shape (n_samples, 6) of an 8-lead EKG of any length.
+
+        The EKG is tiled into windows of `window` samples overlapping by `overlap` samples
+        (the last one is aligned to the end of the EKG, a shorter EKG is zero padded), which
+        are predicted in batches and averaged where they overlap.
+        '''
+        number_samples = ekg_signal.shape[1]
+        starts = list(range(0, max(1, number_samples - window + 1), window - overlap))
+        if starts[-1] + window < number_samples:
+            starts.append(number_samples - window)
+
+        probabilities, counts = None, np.zeros(number_samples, dtype=np.float32)
+        for index_batch in range(0, len(starts), self.batch_size):
+            batch_starts = starts[index_batch: index_batch+self.batch_size]
+            windows = list()
+            for start in batch_starts:
+                ekg_window = ekg_signal[:8, start: start+window]
+                if ekg_window.shape[1] < window:
+                    ekg_window = np.pad(ekg_window, ((0, 0), (0, window - ekg_window.shape[1])))
+                windows.append(ekg_window)
+
+            for start, window_probabilities in zip(batch_starts, self.predict_probabilities(windows)):
+                if probabilities is None:
+                    probabilities = np.zeros((number_samples, window_probabilities.shape[-1]), dtype=np.float32)
+                length = min(window, number_samples - start)
+                probabilities[start: start+length] += window_probabilities[:length]
+                counts[start: start+length] += 1
+
+        return probabilities / counts[:, np.newaxis]
+
+    def predict_long(self, ekg_signal, window=10000, overlap=1000):
+        '''Segment an 8-lead EKG of any length, see predict_probabilities_long.'''
+        return get_segment(self.predict_probabilities_long(ekg_signal, window, overlap))
+
+    @property
+    def throughput(self):
+        '''Records segmented per second so far, model loading excluded.'''
+        return self.number_records / self.elapsed_time if self.elapsed_time else 0.
+
+# one Segmenter per model and options, so repeated calls of predict only load it once
+_segmenters = dict()
+
+def get_segmenter(model_filename, **kwargs):
+    key = (model_filename, tuple(sorted(kwargs.items())))
+    if key not in _segmenters:
+        _segmenters[key] = Segmenter(model_filename, **kwargs)
+    return _segmenters[key]
+
+def predict(model_filename, ekg_signal):
+    return get_segmenter(model_filename).predict(ekg_signal)
 
 if __name__ == '__main__':
     ekg, sampling_rates = reader.get_ekg('/home/toosyou/ext_ssd/Cardiology/交大-normal/大檢查audicor/NOR059/PP-01_001852.bin')
     # ekg, sampling_rates = reader.get_ekg('/home/toosyou/ext_ssd/Cardiology/交大-normal/大檢查audicor/NOR014/PP-01_000914.bin')
-    print(predict('./2000-0.75.h5', ekg))
+    segmenter = get_segmenter('./2000-0.75.h5')
+    print(segmenter.predict(ekg))
+    segmenter.predict_many([ekg] * 256)
+    print('throughput: {:.1f} records/s'.format(segmenter.throughput))
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+'''Export *.bin and *.raw recordings to HDF5, WFDB or EDF, block by block.
+
+The recording is read with iter_heart_sounds (or at once for the short *.bin files),
+so the memory used is bounded by the block size whatever the length of the recording,
+and every block is written with one large sequential write. Samples are exported as
+stored (int16 for *.bin, uint16 for *.raw), without filtering.
+
+    $ python3 export.py some_heart_sounds.raw -f hdf5 -o exported
+    $ python3 export.py /data/audicor -f wfdb -o exported -j 8
+
+h5py is only needed for HDF5.
+'''
+import os
+import re
+import math
+import argparse
+import collections
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from . import reader
+except:
+    import reader
+
+def _recording_blocks(filename, block_s):
+    '''Return the sampling rates, dtype and lengths of the channels of filename, and an
+    iterator over its (sample_offsets, channel_signals) blocks of block_s seconds.
+
+    block_s is rounded to whole seconds, so that a block holds whole WFDB frames and EDF records.
+    '''
+    block_s = max(1, int(round(block_s)))
+    if reader.recording_format(filename) == 'bin': # EKG, 65535 cycles at most
+        data, sampling_rates = reader.get_ekg(filename, do_bandpass_filter=False, native_dtype=True)
+        return sampling_rates, np.dtype(np.int16), [data.shape[1]] * data.shape[0], iter([([0] * data.shape[0], list(data))])
+
+    elif reader.recording_format(filename) == 'raw': # Heart Sound
+        header = reader.get_raw_header(filename)
+        blocks = reader.iter_heart_sounds(filename, block_s=block_s, native_dtype=True)
+        return header.channel_sampling_rate, np.dtype(np.uint16), reader.get_channel_lengths(header), blocks
+
+    raise ValueError('filename must be *.bin or *.raw, got {}'.format(filename))
+
+def _to_int16(signal):
+    '''Shift uint16 samples to the int16 range of WFDB and EDF, int16 samples are unchanged.'''
+    if signal.dtype == np.uint16:
+        return (signal ^ np.uint16(0x8000)).view(np.int16)
+    return signal.astype(np.int16, copy=False)
+
+def _frame_frequency(sampling_rates):
+    '''Greatest frequency of which every sampling rate is an integer multiple.'''
+    if any(rate != int(rate) for rate in sampling_rates):
+        raise ValueError('only integer sampling rates can be exported, got {}'.format(sampling_rates))
+    frequency = 0
+    for rate in sampling_rates:
+        frequency = math.gcd(frequency, int(rate))
+    return frequency
+
+def _progress_blocks(blocks, channel_lengths, itemsize, progress):
+    '''Pass the blocks through, reporting the bytes of the samples up to the end of each block.'''
+    total_bytes = itemsize * sum(channel_lengths)
+    for sample_offsets, channel_signals in blocks:
+        yield sample_offsets, channel_signals
+        if progress is not None:
+            done_bytes = itemsize * sum(offset + len(signal) for offset, signal in zip(sample_offsets, channel_signals))
+            progress(min(done_bytes, total_bytes), total_bytes)
+
+def export_hdf5(filename, output_filename, block_s=600, compression='gzip', compression_opts=4,
+                chunk_samples=2**16, progress=None):
+    '''Export filename to an HDF5 file with one chunked dataset per channel, `channel_<i>`.
+
+    Every dataset has its sampling_rate, gain and offset as attributes (physical value =
+    (sample - offset) * gain), and the file has the source filename and format.
+
+    args:
+        compression: an h5py compression filter, e.g. 'gzip' or 'lzf', or None
+        chunk_samples: samples per HDF5 chunk, the unit of compression and of random access
+        progress: called as progress(bytes exported, total bytes)
+    '''
+    import h5py
+
+    sampling_rates, dtype, channel_lengths, blocks = _recording_blocks(filename, block_s)
+    with h5py.File(output_filename, 'w') as f:
+        f.attrs['source'] = os.path.basename(filename)
+        f.attrs['format'] = 'bin' if dtype == np.int16 else 'raw'
+        f.attrs['number_channels'] = len(channel_lengths)
+
+        datasets = list()
+        for index_channel, (rate, length) in enumerate(zip(sampling_rates, channel_lengths)):
+            dataset = f.create_dataset('channel_{:d}'.format(index_channel), shape=(length,), dtype=dtype,
+                                        chunks=(max(1, min(chunk_samples, length)),) if length else None,
+                                        compression=compression if length else None,
+                                        compression_opts=compression_opts if compression == 'gzip' and length else None)
+            dataset.attrs['sampling_rate'] = rate
+            dataset.attrs['gain'] = 1.
+            dataset.attrs['offset'] = 0.
+            datasets.append(dataset)
+
+        for sample_offsets, channel_signals in _progress_blocks(blocks, channel_lengths, dtype.itemsize, progress):
+            for dataset, offset, signal in zip(datasets, sample_offsets, channel_signals):
+                dataset[offset: offset+len(signal)] = signal
+    return output_filename
+
+def export_wfdb(filename, record_filename, block_s=600, progress=None):
+    '''Export filename to a WFDB record, record_filename.hea and record_filename.dat in format 16.
+
+    Channels of different sampling rates are stored as a multi-frequency record: a frame
+    holds rate / frame frequency samples of each channel, as the interleave cycle of a *.raw file.
+    uint16 samples are shifted by -32768 to fit format 16, the header baseline undoes it.
+
+    args:
+        progress: called as progress(bytes exported, total bytes)
+    '''
+    sampling_rates, dtype, channel_lengths, blocks = _recording_blocks(filename, block_s)
+    frame_frequency = _frame_frequency(sampling_rates)
+    samples_per_frame = [ int(rate) // frame_frequency for rate in sampling_rates ]
+    number_frames = min([ length // spf for length, spf in zip(channel_lengths, samples_per_frame) ], default=0)
+    columns = np.cumsum([0] + samples_per_frame)
+
+    initial_values = [0] * len(samples_per_frame)
+    checksums = [0] * len(samples_per_frame)
+    with open(record_filename + '.dat', 'wb') as f:
+        for sample_offsets, channel_signals in _progress_blocks(blocks, channel_lengths, dtype.itemsize, progress):
+            first_frame = sample_offsets[0] // samples_per_frame[0]
+            block_frames = min(number_frames, first_frame + len(channel_signals[0]) // samples_per_frame[0]) - first_frame
+            if block_frames <= 0:
+                continue
+
+            frames = np.empty((block_frames, columns[-1]), dtype='<i2')
+            for index_channel, (signal, spf) in enumerate(zip(channel_signals, samples_per_frame)):
+                signal = _to_int16(signal[:block_frames * spf])
+                frames[:, columns[index_channel]: columns[index_channel+1]] = signal.reshape(block_frames, spf)
+                if first_frame == 0:
+                    initial_values[index_channel] = int(signal[0])
+                checksums[index_channel] += int(signal.sum(dtype=np.int64))
+            f.write(frames.tobytes())
+
+    baseline = -32768 if dtype == np.uint16 else 0
+    record_name = os.path.basename(record_filename)
+    lines = ['{} {:d} {:d} {:d}'.format(record_name, len(samples_per_frame), frame_frequency, number_frames)]
+    for index_channel, spf in enumerate(samples_per_frame):
+        checksum = (checksums[index_channel] + 32768) % 65536 - 32768 # 16-bit signed
+        lines.append('{}.dat 16{} 1({:d})/adu 16 0 {:d} {:d} 0 channel {:d}'.format(
+                        record_name, 'x{:d}'.format(spf) if spf > 1 else '', baseline,
+                        initial_values[index_channel], checksum, index_channel))
+    lines.append('# exported from {}'.format(os.path.basename(filename)))
+    with open(record_filename + '.hea', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return record_filename + '.hea'
+
+def _edf_field(value, width):
+    return '{:<{}}'.format(value, width)[:width].encode('ascii')
+
+def export_edf(filename, output_filename, block_s=600, progress=None):
+    '''Export filename to an EDF file of one-second data records.
+
+    uint16 samples are shifted by -32768 to the 16-bit EDF digital range, the physical
+    range of the header undoes it. The last record is padded with the last samples.
+
+    args:
+        progress: called as progress(bytes exported, total bytes)
+    '''
+    sampling_rates, dtype, channel_lengths, blocks = _recording_blocks(filename, block_s)
+    _frame_frequency(sampling_rates) # integer rates: one-second records hold whole samples
+    samples_per_record = [ int(rate) for rate in sampling_rates ]
+    columns = np.cumsum([0] + samples_per_record)
+    number_signals = len(samples_per_record)
+    physical_min, physical_max = (0, 65535) if dtype == np.uint16 else (-32768, 32767)
+
+    header = (_edf_field('0', 8) + _edf_field('X X X X', 80) + _edf_field('Startdate X X X X', 80)
+                + _edf_field('01.01.85', 8) + _edf_field('00.00.00', 8) + _edf_field(256 * (number_signals + 1), 8)
+                + _edf_field('', 44) + _edf_field(-1, 8) + _edf_field(1, 8) + _edf_field(number_signals, 4))
+    for field, width in [ ('channel {:d}', 16), ('', 80), ('adu', 8), (physical_min, 8), (physical_max, 8),
+                            (-32768, 8), (32767, 8), ('', 80), (None, 8), ('', 32) ]:
+        for index_channel in range(number_signals):
+            if field is None:
+                value = samples_per_record[index_channel]
+            elif isinstance(field, str):
+                value = field.format(index_channel)
+            else:
+                value = field
+            header += _edf_field(value, width)
+
+    number_records = 0
+    with open(output_filename, 'wb') as f:
+        f.write(header)
+        for sample_offsets, channel_signals in _progress_blocks(blocks, channel_lengths, dtype.itemsize, progress):
+            block_records = max([ -(-len(signal) // n) for signal, n in zip(channel_signals, samples_per_record) ], default=0)
+            if block_records == 0:
+                continue
+
+            records = np.empty((block_records, columns[-1]), dtype='<i2')
+            for index_channel, (signal, n) in enumerate(zip(channel_signals, samples_per_record)):
+                signal = _to_int16(signal)
+                if len(signal) < block_records * n: # the end of the recording
+                    padding = signal[-1:] if len(signal) else np.zeros(1, dtype=np.int16)
+                    signal = np.concatenate([signal, np.repeat(padding, block_records * n - len(signal))])
+                records[:, columns[index_channel]: columns[index_channel+1]] = signal.reshape(block_records, n)
+            f.write(records.tobytes())
+            number_records += block_records
+
+        f.seek(236) # number of data records, unknown until the end
+        f.write(_edf_field(number_records, 8))
+    return output_filename
+
+EXPORTERS = {
+    'hdf5': (export_hdf5, '.h5'),
+    'wfdb': (export_wfdb, ''),
+    'edf': (export_edf, '.edf'),
+}
+
+def get_output_filename(filename, file_format, output_dir=''):
+    '''Return the file export writes filename to.'''
+    name = os.path.basename(filename)
+    if file_format == 'wfdb': # record names are made of letters, digits and underscores
+        name = re.sub(r'[^A-Za-z0-9_]', '_', name)
+    return os.path.join(output_dir, name + EXPORTERS[file_format][1])
+
+def export(filename, file_format, output_dir='', block_s=600):
+    '''Export filename to output_dir in file_format (see EXPORTERS) and return the file written.'''
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    output_filename = get_output_filename(filename, file_format, output_dir)
+    print('Export {} to {}!'.format(filename, output_filename))
+    return EXPORTERS[file_format][0](filename, output_filename, block_s=block_s)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export *.bin and *.raw recordings to HDF5, WFDB or EDF.')
+    parser.add_argument('filenames', nargs='+', metavar='filename',
+                        help='Filenames, directories or glob patterns to export. Must be *.bin or *.raw (case-insensitive).')
+    parser.add_argument('-f', '--format', help='Output format. (default: hdf5)',
+                        dest='format', choices=list(EXPORTERS), default='hdf5')
+    parser.add_argument('-o', '--output-dir', help='Directory to write the exported files to, the subdirectories of the input files are mirrored in it. (default: current directory)',
+                        dest='output_dir', default='')
+    parser.add_argument('-b', '--block', help='Whole seconds of recording read and written at once. (default: 600)',
+                        dest='block_s', type=float, default=600)
+    parser.add_argument('-j', '--jobs', help='Number of files exported in parallel. (default: 1)',
+                        dest='jobs', type=int, default=1)
+    args = parser.parse_args()
+
+    filenames = reader.collect_filenames(args.filenames)
+    output_dirs = reader._output_dirs(filenames, args.output_dir) # as reader.py batch mode
+    # e.g. a.raw and a_raw.raw are both the WFDB record a_raw
+    output_filenames = collections.Counter(os.path.abspath(get_output_filename(filename, args.format, output_dir))
+                                            for filename, output_dir in zip(filenames, output_dirs))
+    collisions = sorted(name for name, count in output_filenames.items() if count > 1)
+    if collisions:
+        parser.error('several files would be exported to {}'.format(', '.join(collisions)))
+
+    if args.jobs > 1 and len(filenames) > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as workers:
+            outputs = list(workers.map(export, filenames, [args.format] * len(filenames),
+                                        output_dirs, [args.block_s] * len(filenames)))
+    else:
+        outputs = [ export(filename, args.format, output_dir, args.block_s) for filename, output_dir in zip(filenames, output_dirs) ]
+    print('Done: {} exported.'.format(len(outputs)))
@@ -1,11 +1,14 @@
 import re
 import datetime
+import queue
+import threading
 import numpy as np
 import tkinter as tk
 import matplotlib
 matplotlib.use('TkAgg')
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from matplotlib.figure import Figure
+from matplotlib.transforms import offset_copy
 
 import platform
 import os
@@ -18,6 +21,7 @@ else: # mac
 from tkdnd_wrapper import TkDND
 
 import reader
+import pyramid
 
 class App:
     def __init__(self):
@@ -27,8 +31,24 @@ class App:
 
         # has not been loaded yet
         self.signal, self.sampling_rates = None, None
+        self.pyramids = None
         self.signal_length = -1 # in seconds
 
+        # background loading
+        self.filename = None
+        self.loading_id = 0
+        self.loading_queue = queue.Queue()
+        self.loading_block_s = 60
+        self.loaded_cycles = None # number of interleave cycles loaded, once loading is done
+        self.pyramid_lengths = None # number of samples covered by the pyramids
+
+        # follow mode: the samples appended to the file are read and the window moves to the end
+        self.follow = tk.BooleanVar(value=False)
+        self.follow_interval_ms = 1000
+        self.pending_follow = None
+        self.tail = None
+        self.buffers = None # per channel, self.signal[i] is the filled part of buffers[i]
+
         # add signal figure
         self.time_interval = 10
         self.figure = Figure(figsize=(15, 12), dpi=100)
@@ -36,6 +56,16 @@ class App:
         self.canvas.get_tk_widget().grid(row=0, columnspan=3, sticky='NSEW')
         self.axes = None
         self.lines = None
+        self.tick_texts = None
+
+        # blitting: the figure without the lines and time labels is cached after every full draw
+        self.background = None
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+
+        # slider and keyboard events are coalesced, only the latest position is drawn
+        self.update_delay_ms = 15
+        self.pending_update = None
+        self.pending_start_time = 0
 
         # set resizable
         self.tk_root.columnconfigure(0, weight=1)
@@ -53,6 +83,10 @@ class App:
         self.rescale_button = tk.Button(self.time_frame, width=5, text='Rescale', command=self.rescale_plot)
         self.rescale_button.pack(side=tk.LEFT, padx=5)
 
+        # add follow check box
+        self.follow_button = tk.Checkbutton(self.time_frame, text='Follow', variable=self.follow, command=self.toggle_follow)
+        self.follow_button.pack(side=tk.LEFT, padx=5)
+
         # add slider bar for time
         self.time_slider = tk.Scale(self.time_frame,
                                     from_=0, to=self.signal_length-self.time_interval-1,
@@ -132,12 +166,123 @@ class App:
 
     def load_data(self, event):
         filename = re.sub(r'^\{|}$', '', event.data) # remove {} in the begining or the end if any
-        self.tk_root.title(filename)
-        self.signal, self.sampling_rates = reader.get_heart_sounds(filename)
-        self.signal_length = self.signal[0].shape[0] // self.sampling_rates[0] # in seconds
-        self.time_slider.configure(to=self.signal_length-self.time_interval-1)
-        self.time_slider.set(0)
-        self.initial_plot()
+        self.tk_root.title(filename + ' - loading...')
+
+        # a newer loading_id makes the previous worker stop
+        self.loading_id += 1
+        self.signal, self.pyramids = None, None
+        self.filename, self.loaded_cycles = filename, None
+        self.stop_follow()
+        self.tail, self.buffers = None, None
+        threading.Thread(target=self.load_worker, args=(filename, self.loading_id), daemon=True).start()
+        self.tk_root.after(100, self.poll_loading, filename, self.loading_id)
+
+    def load_worker(self, filename, loading_id):
+        '''Decode filename block by block in the background, reporting to loading_queue.'''
+        try:
+            header = reader.get_raw_header(filename)
+            channel_lengths = reader.get_channel_lengths(header)
+            if len(set(channel_lengths)) == 1:
+                signal = np.zeros((header.number_channels, channel_lengths[0]))
+            else: # mixed sampling rates
+                signal = np.empty(header.number_channels, dtype=object)
+                signal[:] = [ np.zeros(length) for length in channel_lengths ]
+
+            # with the same header, so that the samples appended since (while recording) are left to follow mode
+            for sample_offsets, channel_signals in reader.iter_heart_sounds(filename, block_s=self.loading_block_s, header=header):
+                if loading_id != self.loading_id:
+                    return
+                for index_channel, (offset, channel_signal) in enumerate(zip(sample_offsets, channel_signals)):
+                    signal[index_channel][offset: offset+len(channel_signal)] = channel_signal
+                loaded_s = min(header.total_time_in_sec, (sample_offsets[0] + len(channel_signals[0])) / header.channel_sampling_rate[0])
+                self.loading_queue.put((loading_id, 'progress', (signal, header.channel_sampling_rate, loaded_s, header.total_time_in_sec)))
+
+            self.loading_queue.put((loading_id, 'done', (pyramid.load_pyramids(filename, signal), header.number_cycles)))
+        except Exception as e:
+            self.loading_queue.put((loading_id, 'error', e))
+
+    def poll_loading(self, filename, loading_id):
+        finished = False
+        while not self.loading_queue.empty():
+            message_id, status, content = self.loading_queue.get()
+            if message_id != loading_id or loading_id != self.loading_id: # from an outdated loading
+                continue
+
+            if status == 'progress':
+                signal, sampling_rates, loaded_s, total_s = content
+                self.tk_root.title('{} - loading {:.0f}%'.format(filename, 100 * loaded_s / total_s if total_s else 100))
+                self.set_loaded_length(loaded_s)
+                if self.signal is None: # show the first window as soon as it is decoded
+                    self.signal, self.sampling_rates = signal, sampling_rates
+                    self.time_slider.set(0)
+                    self.initial_plot()
+                    self.update_plot(0)
+            elif status == 'done':
+                self.pyramids, self.loaded_cycles = content
+                self.pyramid_lengths = [ len(signal) for signal in self.signal ]
+                self.tk_root.title(filename)
+                self.update_plot(self.time_slider.get())
+                if self.follow.get():
+                    self.start_follow()
+                finished = True
+            else:
+                self.tk_root.title('{} - failed to load: {}'.format(filename, content))
+                finished = True
+
+        if not finished and loading_id == self.loading_id:
+            self.tk_root.after(100, self.poll_loading, filename, loading_id)
+
+    def toggle_follow(self):
+        if not self.follow.get():
+            self.stop_follow()
+        elif self.loaded_cycles is not None: # otherwise started once loading is done
+            self.start_follow()
+
+    def start_follow(self):
+        if self.pending_follow is not None:
+            return
+        if self.tail is None:
+            # continue after the cycles already loaded, into buffers growing geometrically
+            self.tail = reader.RawTail(self.filename, start_cycle=self.loaded_cycles)
+            self.buffers = [ np.asarray(signal) for signal in self.signal ]
+            self.signal = np.empty(len(self.buffers), dtype=object)
+            for index_channel, buffer in enumerate(self.buffers):
+                self.signal[index_channel] = buffer
+        self.poll_follow(self.loading_id)
+
+    def stop_follow(self):
+        if self.pending_follow is not None:
+            self.tk_root.after_cancel(self.pending_follow)
+            self.pending_follow = None
+
+    def poll_follow(self, loading_id):
+        self.pending_follow = None
+        if loading_id != self.loading_id or not self.follow.get():
+            return
+
+        _, channel_signals = self.tail.read_new()
+        if any(len(signal) for signal in channel_signals):
+            self.append_samples(channel_signals)
+            self.set_loaded_length(self.tail.time_in_sec)
+            sec = max(0, self.signal_length-self.time_interval-1)
+            self.time_slider.set(sec)
+            self.time_slider_callback(sec)
+        self.pending_follow = self.tk_root.after(self.follow_interval_ms, self.poll_follow, loading_id)
+
+    def append_samples(self, channel_signals):
+        for index_channel, new_signal in enumerate(channel_signals):
+            length, buffer = len(self.signal[index_channel]), self.buffers[index_channel]
+            if length + len(new_signal) > len(buffer): # amortized O(1) per sample
+                grown = np.empty(max(2 * len(buffer), length + len(new_signal)), dtype=buffer.dtype)
+                grown[:length] = buffer[:length]
+                self.buffers[index_channel] = buffer = grown
+            buffer[length: length+len(new_signal)] = new_signal
+            self.signal[index_channel] = buffer[:length+len(new_signal)]
+
+    def set_loaded_length(self, loaded_s):
+        # only let the slider reach the decoded range
+        self.signal_length = int(loaded_s) # in seconds
+        self.time_slider.configure(to=max(0, self.signal_length-self.time_interval-1))
 
     def rescale_plot(self, _=None):
         for ax in self.axes:
@@ -163,35 +308,97 @@ class App:
 
     def time_slider_callback(self, time_in_sec):
         self.set_time_of_box(int(time_in_sec))
-        self.update_plot(int(time_in_sec))
+        self.schedule_update(int(time_in_sec))
+
+    def schedule_update(self, start_time):
+        self.pending_start_time = start_time
+        if self.pending_update is None:
+            self.pending_update = self.tk_root.after(self.update_delay_ms, self.flush_update)
+
+    def flush_update(self):
+        self.pending_update = None
+        self.update_plot(self.pending_start_time)
 
     @staticmethod
     def sec_to_timestring(sec):
         return str(datetime.timedelta(seconds=int(sec)))
 
+    def get_max_points(self):
+        # about two envelope points per pixel of the canvas
+        return max(1000, 2 * self.canvas.get_tk_widget().winfo_width())
+
+    def get_plot_data(self, index_channel, start_s, end_s):
+        sampling_rate = self.sampling_rates[index_channel]
+        signal = self.signal[index_channel]
+        start_index, end_index = start_s*sampling_rate, end_s*sampling_rate
+        if self.pyramids is not None and end_index <= self.pyramid_lengths[index_channel]:
+            return pyramid.get_envelope(signal, self.pyramids[index_channel], start_index, end_index, self.get_max_points())
+
+        # still loading, or samples appended in follow mode: reduce the window alone
+        start_index = max(0, int(start_index))
+        return pyramid.min_max_envelope(signal[start_index: max(start_index, int(end_index))], self.get_max_points())
+
     def initial_plot(self):
         self.figure.clf()
+        self.background = None
 
         start_s = 0
         end_s = start_s + self.time_interval
 
         self.axes = list()
         self.lines = list()
+        self.tick_texts = list()
         for index_channel, (channel_data, sampling_rate) in enumerate(zip(self.signal, self.sampling_rates)):
             ax = self.figure.add_subplot(self.signal.shape[0], 1, index_channel+1)
 
-            channel_data = channel_data[ int(start_s*sampling_rate): int(end_s*sampling_rate)]
-            line, = ax.plot(channel_data)
-            ax.set_xticks(np.linspace(0., self.time_interval*sampling_rate, num=10))
+            line, = ax.plot(*self.get_plot_data(index_channel, start_s, end_s), animated=True)
+            ax.set_xlim(0, self.time_interval*sampling_rate)
+            ticks = np.linspace(0., self.time_interval*sampling_rate, num=10)
+            ax.set_xticks(ticks)
+
+            # the real tick labels only reserve the space, the time is drawn by animated texts
             ax.set_xticklabels([self.sec_to_timestring(s) for s in np.linspace(start_s, end_s, num=10)])
+            ax.tick_params(axis='x', labelcolor='none')
+            label_transform = offset_copy(ax.get_xaxis_transform(), fig=self.figure, y=-7, units='points')
+            self.tick_texts.append([ ax.text(tick, 0, '', transform=label_transform, animated=True,
+                                                ha='center', va='top', fontsize=matplotlib.rcParams['xtick.labelsize'])
+                                        for tick in ticks ])
 
             ax.margins(x=0, y=0)
             self.lines.append(line)
             self.axes.append(ax)
 
+        self.set_tick_texts(start_s, end_s)
         self.figure.tight_layout()
         self.canvas.draw()
 
+    def set_tick_texts(self, start_s, end_s):
+        labels = [self.sec_to_timestring(s) for s in np.linspace(start_s, end_s, num=10)]
+        for texts in self.tick_texts:
+            for text, label in zip(texts, labels):
+                text.set_text(label)
+
+    def on_draw(self, _):
+        # cache the static part of the figure after every full draw (first plot, rescale, resize)
+        if self.lines is None:
+            return
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+        self.draw_animated()
+
+    def draw_animated(self):
+        for ax, line, texts in zip(self.axes, self.lines, self.tick_texts):
+            ax.draw_artist(line)
+            for text in texts:
+                ax.draw_artist(text)
+
+    def blit(self):
+        if self.background is None:
+            self.canvas.draw()
+            return
+        self.canvas.restore_region(self.background)
+        self.draw_animated()
+        self.canvas.blit(self.figure.bbox)
+
     def update_plot(self, start_time):
         if self.signal is None:
             return
@@ -199,13 +406,11 @@ class App:
         start_s = start_time
         end_s = start_s + self.time_interval
 
-        for index_channel, (ax, line, channel_data, sampling_rate) in enumerate(zip(self.axes, self.lines, self.signal, self.sampling_rates)):
-            channel_data = channel_data[ int(start_s*sampling_rate): int(end_s*sampling_rate)]
-            ax.set_xticks(np.linspace(0., self.time_interval*sampling_rate, num=10))
-            ax.set_xticklabels([self.sec_to_timestring(s) for s in np.linspace(start_s, end_s, num=10)])
-            line.set_ydata(channel_data)
+        for index_channel, line in enumerate(self.lines):
+            line.set_data(*self.get_plot_data(index_channel, start_s, end_s))
+        self.set_tick_texts(start_s, end_s)
 
-        self.canvas.draw()
+        self.blit()
 
     def loop(self):
         self.tk_root.mainloop()
@@ -0,0 +1,143 @@
+'''Timing and memory spans around the stages of the pipeline, and progress reporting.
+
+Spans are only recorded while profiling is enabled (see enable()), otherwise span()
+does nothing. They are saved in the Chrome trace event format, which is plain JSON, so
+that a profile can be read by scripts or opened in chrome://tracing or Perfetto.
+
+    with profiling.span('decode', filename=filename) as info:
+        data = ...
+        info['samples'] = data.size
+
+Progress callbacks are called as progress(done, total), in bytes for the readers and in
+samples for the denoisers, as the work actually advances.
+'''
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+
+def peak_rss_mb():
+    '''Peak resident memory of this process so far, or None where resource is not available (Windows).'''
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10 # bytes on macOS, KiB on Linux
+
+def current_rss_mb():
+    '''Resident memory of this process, or None where /proc is not available.'''
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, IndexError):
+        return None
+
+class Profiler:
+    '''Record the time and memory of named spans, from any thread.'''
+    def __init__(self):
+        # timestamps are taken with perf_counter, anchored to the wall clock so that
+        # the spans of several processes line up
+        self.origin = time.time() - time.perf_counter()
+        self.events = list()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        '''Time the body of the with statement, which can add entries to the yielded args.'''
+        rss_start = current_rss_mb()
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            end = time.perf_counter()
+            args.update(rss_start_mb=rss_start, rss_end_mb=current_rss_mb(), peak_rss_mb=peak_rss_mb())
+            event = {'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                        'ts': (self.origin + start) * 1e6, 'dur': (end - start) * 1e6, 'args': args}
+            with self.lock:
+                self.events.append(event)
+
+    def pop_events(self):
+        '''Return the events recorded so far and forget them.'''
+        with self.lock:
+            events, self.events = self.events, list()
+        return events
+
+    def add_events(self, events):
+        '''Add events recorded by another profiler, e.g. in a worker process.'''
+        with self.lock:
+            self.events.extend(events)
+
+    def summary(self):
+        '''Return the number of spans, total seconds and peak RSS (None if unknown) of every span name.'''
+        stages = dict()
+        for event in self.events:
+            stage = stages.setdefault(event['name'], {'count': 0, 'total_s': 0., 'peak_rss_mb': None})
+            stage['count'] += 1
+            stage['total_s'] += event['dur'] / 1e6
+            peak = event['args']['peak_rss_mb']
+            if peak is not None:
+                stage['peak_rss_mb'] = peak if stage['peak_rss_mb'] is None else max(stage['peak_rss_mb'], peak)
+        return stages
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': sorted(self.events, key=lambda event: event['ts']),
+                        'displayTimeUnit': 'ms', 'stages': self.summary()}, f, indent=1)
+
+_profiler = None
+
+def enable():
+    '''Start recording the spans of this process and return the Profiler.'''
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler()
+    return _profiler
+
+def disable():
+    '''Stop recording and return the Profiler, or None if profiling was not enabled.'''
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+def get_profiler():
+    return _profiler
+
+def span(name, **args):
+    '''Record a span if profiling is enabled, see Profiler.span.'''
+    if _profiler is None:
+        return contextlib.nullcontext(args)
+    return _profiler.span(name, **args)
+
+class ProgressPrinter:
+    '''Progress callback printing the throughput measured so far and the ETA it gives.
+
+    args:
+        label: what is in progress, e.g. 'reading'
+        unit, scale: name and size of the unit printed, MB of bytes by default
+        interval_s: minimum time between two prints, the end is always printed
+    '''
+    def __init__(self, label, unit='MB', scale=2**20, interval_s=1., file=None):
+        self.label, self.unit, self.scale = label, unit, scale
+        self.interval_s = interval_s
+        self.file = file
+        self.start = time.perf_counter()
+        self.last_print = self.start
+
+    def __call__(self, done, total):
+        now = time.perf_counter()
+        if done < total and now - self.last_print < self.interval_s:
+            return
+        self.last_print = now
+
+        elapsed = now - self.start
+        rate = done / elapsed if elapsed > 0 else 0.
+        if done < total:
+            eta = '{:.1f}s'.format((total - done) / rate) if rate > 0 else '?'
+            print('{}... {:.0f}% {:.1f} {}/s ETA: {}'.format(self.label, 100. * done / total, rate / self.scale,
+                                                            self.unit, eta), file=self.file or sys.stdout)
+        else:
+            print('{}... done in {:.1f}s, {:.1f} {}/s'.format(self.label, elapsed, rate / self.scale, self.unit),
+                    file=self.file or sys.stdout)
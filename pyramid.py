@@ -0,0 +1,106 @@
+'''Min/max decimation pyramid for drawing long signals.
+
+Level k of the pyramid keeps the minimum and the maximum of every bin of
+bin_size * factor**k samples, so that any window of a signal can be drawn as an
+envelope of at most a few thousand points whatever its length.
+'''
+import numpy as np
+
+try:
+    from . import cache
+except:
+    import cache
+
+def _reduce_bins(mins, maxs, bin_size):
+    '''Reduce consecutive bins of bin_size values into one, the last one may be shorter.'''
+    number_full = mins.shape[0] // bin_size * bin_size
+    new_mins = mins[:number_full].reshape(-1, bin_size).min(axis=1)
+    new_maxs = maxs[:number_full].reshape(-1, bin_size).max(axis=1)
+    if number_full < mins.shape[0]:
+        new_mins = np.append(new_mins, mins[number_full:].min())
+        new_maxs = np.append(new_maxs, maxs[number_full:].max())
+    return new_mins, new_maxs
+
+def build_pyramid(signal, bin_size=16, factor=4, min_bins=1024):
+    '''Build the pyramid of a 1-D signal.
+
+    returns:
+        list of (bin_size, mins, maxs), from the finest level to the coarsest
+    '''
+    signal = np.asarray(signal)
+    levels = list()
+    mins, maxs = _reduce_bins(signal, signal, bin_size)
+    levels.append((bin_size, mins, maxs))
+    while mins.shape[0] > min_bins:
+        bin_size *= factor
+        mins, maxs = _reduce_bins(mins, maxs, factor)
+        levels.append((bin_size, mins, maxs))
+    return levels
+
+def get_envelope(signal, pyramid, start_index, end_index, max_points):
+    '''Return (x, y) to draw signal[start_index:end_index] with about max_points points at most.
+
+    x is relative to start_index. Windows short enough are returned as raw samples,
+    longer ones as the interleaved min/max of the finest pyramid level that fits.
+    '''
+    start_index, end_index = max(0, int(start_index)), min(len(signal), int(end_index))
+    if end_index - start_index <= max_points or not pyramid:
+        return np.arange(end_index - start_index), signal[start_index:end_index]
+
+    for bin_size, mins, maxs in pyramid:
+        if (end_index - start_index) / bin_size * 2 <= max_points:
+            break
+
+    start_bin, end_bin = start_index // bin_size, -(-end_index // bin_size)
+    y = np.empty(2 * (end_bin - start_bin), dtype=mins.dtype)
+    y[0::2] = mins[start_bin:end_bin]
+    y[1::2] = maxs[start_bin:end_bin]
+    x = np.repeat(np.arange(start_bin, end_bin) * bin_size, 2) - start_index
+    x[1::2] += bin_size // 2
+    return x, y
+
+def min_max_envelope(signal, max_points):
+    '''Return (x, y) to draw the whole signal with about max_points points at most.
+
+    Unlike get_envelope, no pyramid is needed: the bins are sized to fit max_points
+    exactly, which suits a one-off rendering such as a saved figure.
+    '''
+    signal = np.asarray(signal)
+    bin_size = -(-2 * len(signal) // max(2, int(max_points)))
+    if bin_size <= 1:
+        return np.arange(len(signal)), signal
+
+    mins, maxs = _reduce_bins(signal, signal, bin_size)
+    y = np.empty(2 * mins.shape[0], dtype=mins.dtype)
+    y[0::2] = mins
+    y[1::2] = maxs
+    x = np.repeat(np.arange(mins.shape[0]) * bin_size, 2)
+    x[1::2] += bin_size // 2
+    return x, y
+
+def _pyramid_name(index_channel):
+    return 'pyramid_{:d}'.format(index_channel)
+
+def load_pyramids(filename, signals, **kwargs):
+    '''Build the pyramid of every channel of a recording.
+
+    The pyramids are stored alongside the columnar cache of filename (see cache.py)
+    if it exists, and loaded from it the next time.
+    '''
+    pyramids = list()
+    for index_channel, signal in enumerate(signals):
+        arrays = cache.load_extra(filename, _pyramid_name(index_channel))
+        if arrays is not None and int(arrays['length']) == len(signal):
+            pyramids.append(list(zip(arrays['bin_sizes'].tolist(),
+                                        [ arrays['mins_{:d}'.format(i)] for i in range(len(arrays['bin_sizes'])) ],
+                                        [ arrays['maxs_{:d}'.format(i)] for i in range(len(arrays['bin_sizes'])) ])))
+            continue
+
+        levels = build_pyramid(signal, **kwargs)
+        arrays = { 'length': len(signal), 'bin_sizes': np.array([ bin_size for bin_size, _, _ in levels ]) }
+        for i, (_, mins, maxs) in enumerate(levels):
+            arrays['mins_{:d}'.format(i)] = mins
+            arrays['maxs_{:d}'.format(i)] = maxs
+        cache.save_extra(filename, _pyramid_name(index_channel), arrays)
+        pyramids.append(levels)
+    return pyramids
@@ -6,45 +6,113 @@ if sys.version_info < (3, 0):
 
 import os
 import numpy as np
-import matplotlib as mpl
-mpl.use('Agg')
-from matplotlib import pyplot as plt
 import argparse
-import re
+import glob
+import json
+import collections
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import time, datetime
-from scipy.signal import spectrogram
 
 try:
-    from . import denoise
+    from . import cache
+    from . import profiling
+    from . import pyramid
+    from . import spectrogram
+    from .recording import Recording
 except:
-    import denoise
-
-def generate_spectrogram(raw_data, sampling_rates):
-    result = list()
-    for signal, sr in zip(raw_data, sampling_rates):
-        f, t, Sxx = spectrogram(signal, sr, nperseg=int(sr/20), noverlap=int(sr/80), nfft=2048)
-        result.append([f, t, Sxx])
-    return result
-
-def save_fig(filename, data, grid=False, peak_indices=None, segment_indices=None, figsize=None):
+    import cache
+    import profiling
+    import pyramid
+    import spectrogram
+    from recording import Recording
+
+# matplotlib, scipy and pywt (through denoise) take most of the import time,
+# they are only imported by the code paths using them
+def _import_pyplot():
+    import matplotlib as mpl
+    mpl.use('Agg')
+    from matplotlib import pyplot as plt
+    return mpl, plt
+
+def _import_denoise():
+    try:
+        from . import denoise
+    except ImportError:
+        import denoise
+    return denoise
+
+def recording_format(filename):
+    '''Return 'bin' (EKG) or 'raw' (heart sound) from the extension of filename, or None.'''
+    extension = os.path.splitext(filename)[1].lower()
+    return extension[1:] if extension in ('.bin', '.raw') else None
+
+def generate_spectrogram(raw_data, sampling_rates, fmax=50, time_resolution_s=None):
+    '''Spectrograms of every channel, computed in parallel threads.
+
+    args:
+        fmax: highest frequency computed, None for all of them
+        time_resolution_s: average the spectrogram over time to about this resolution (default: no average)
+
+    returns:
+        list of [f, t, Sxx], Sxx in float32
+    '''
+    def compute(signal, sr):
+        nperseg, noverlap = int(sr/20), int(sr/80)
+        average_frames = 1 if time_resolution_s is None else int(time_resolution_s * sr / (nperseg - noverlap))
+        return list(spectrogram.band_spectrogram(signal, sr, nperseg=nperseg, noverlap=noverlap, nfft=2048,
+                                                    fmax=fmax, average_frames=average_frames))
+
+    with ThreadPoolExecutor(max_workers=max(1, min(len(sampling_rates), os.cpu_count() or 1))) as workers:
+        return list(workers.map(compute, raw_data, sampling_rates))
+
+def _add_grid_lines(ax, values, vertical=False, **kwargs):
+    '''Draw lines across the whole axes at values as one collection (instead of an axhline/axvline each).
+
+    The data limits are extended to the values, as axhline/axvline do.
+    '''
+    from matplotlib.collections import LineCollection
+    values = np.asarray(values, dtype=float)
+    if values.shape[0] == 0:
+        return None
+    if vertical:
+        segments = [ [(v, 0), (v, 1)] for v in values ]
+        transform = ax.get_xaxis_transform()
+        ax.update_datalim(np.column_stack([values, np.zeros_like(values)]), updatey=False)
+    else:
+        segments = [ [(0, v), (1, v)] for v in values ]
+        transform = ax.get_yaxis_transform()
+        ax.update_datalim(np.column_stack([np.zeros_like(values), values]), updatex=False)
+    lines = LineCollection(segments, transform=transform, **kwargs)
+    ax.add_collection(lines, autolim=False)
+    return lines
+
+def _figure_width_pixels(fig):
+    return int(fig.get_size_inches()[0] * fig.dpi)
+
+def save_fig(filename, data, grid=False, peak_indices=None, segment_indices=None, figsize=None, decimate=True):
+    '''Plot every channel of data in its own row.
+
+    decimate: draw each channel as its min/max envelope at the resolution of the figure
+        (2 points per pixel column) rather than every sample, which looks the same but
+        renders long recordings much faster
+    '''
+    mpl, plt = _import_pyplot()
     mpl.rcParams['agg.path.chunksize'] = 10000
     if figsize is None:
         figsize = (20, 2*data.shape[0])
     fig = plt.figure(figsize=figsize)
+    max_points = 2 * _figure_width_pixels(fig)
     for index_channel, channel_data in enumerate(data):
-        fig.add_subplot(data.shape[0], 1, index_channel+1)
+        ax = fig.add_subplot(data.shape[0], 1, index_channel+1)
         if grid:
             if index_channel < 8: # no voltage grid on heart sounds
                 y_major_grid = [510. * i for i in range(-4, 5)]
-                for yi in y_major_grid:
-                    plt.axhline(yi, linestyle='-', color='r', alpha=0.1)
+                _add_grid_lines(ax, y_major_grid, linestyle='-', color='r', alpha=0.1)
             x_major_grid = [0.2*1000.*i for i in range(int(10/0.2+1))]
-            for xi in x_major_grid:
-                plt.axvline(xi, linestyle='-', color='r', alpha=0.1)
+            _add_grid_lines(ax, x_major_grid, vertical=True, linestyle='-', color='r', alpha=0.1)
 
         if segment_indices is not None:
-            for si in segment_indices:
-                plt.axvline(si, linestyle='-', color='black', alpha=1.)
+            _add_grid_lines(ax, segment_indices, vertical=True, linestyle='-', color='black', alpha=1.)
         if peak_indices is not None and index_channel < 8:
             colors = ['g', 'm', 'y', 'k', 'c']
             labels = ['P', 'Q', 'R', 'S', 'T']
@@ -52,21 +120,48 @@ def save_fig(filename, data, grid=False, peak_indices=None, segment_indices=None
                 plt.scatter(px, channel_data[px], color=ci, label=li, alpha=0.5, s=20)
             plt.legend(prop={'size': 6})
 
-        plt.plot(channel_data)
+        if decimate:
+            plt.plot(*pyramid.min_max_envelope(channel_data, max_points))
+        else:
+            plt.plot(channel_data)
         plt.margins(x=0, y=0)
 
     fig.tight_layout()
     if filename: fig.savefig(filename)
     else: plt.show()
 
-def save_spectrogram_fig(filename, data, figsize=None):
+def _average_columns(Sxx, max_columns):
+    '''Average consecutive columns of Sxx so that it has max_columns at most.'''
+    if Sxx.shape[1] <= max_columns:
+        return Sxx
+    boundaries = np.linspace(0, Sxx.shape[1], max_columns + 1).astype(int)[:-1]
+    return (np.add.reduceat(Sxx, boundaries, axis=1) / np.diff(np.append(boundaries, Sxx.shape[1]))).astype(Sxx.dtype)
+
+def _cell_edges(centers):
+    '''Edges of the cells centered on the evenly spaced centers, as pcolormesh draws them.'''
+    step = centers[1] - centers[0] if len(centers) > 1 else 1.
+    return centers[0] - step / 2, centers[-1] + step / 2
+
+def save_spectrogram_fig(filename, data, figsize=None, decimate=True):
+    '''Plot the spectrogram [f, t, Sxx] of every channel in its own row.
+
+    decimate: draw each spectrogram as an image of at most one column per pixel
+        rather than a mesh of every time bin, which looks the same but renders much faster
+    '''
+    mpl, plt = _import_pyplot()
     mpl.rcParams['agg.path.chunksize'] = 10000
     if figsize is None:
         figsize = (20, 2*len(data))
     fig = plt.figure(figsize=figsize)
+    max_columns = _figure_width_pixels(fig)
     for index_signal, (f, t, Sxx) in enumerate(data):
         ax = fig.add_subplot(len(data), 1, index_signal+1)
-        ax.pcolormesh(t, f, Sxx)
+        if not decimate:
+            ax.pcolormesh(t, f, Sxx)
+        elif Sxx.size:
+            # same color scale as the full resolution mesh
+            ax.imshow(_average_columns(Sxx, max_columns), aspect='auto', origin='lower', interpolation='nearest',
+                        extent=_cell_edges(t) + _cell_edges(f), vmin=Sxx.min(), vmax=Sxx.max())
         ax.set_ylim(0, 50)
         plt.ylabel('Frequency [Hz]')
 
@@ -75,7 +170,14 @@ def save_spectrogram_fig(filename, data, figsize=None):
     if filename: fig.savefig(filename)
     else: plt.show()
 
-def get_ekg(filename, do_bandpass_filter=True, filter_lowcut=30, filter_highcut=100):
+def _memmap_samples(filename, offset, dtype, shape):
+    '''Map `shape` samples of `dtype` starting at byte `offset` as a read-only array.'''
+    if np.prod(shape) == 0: # np.memmap refuses to map an empty region
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+def _read_ekg_header(filename):
+    '''Return the number of ekg channels, heart sound channels and cycles of a *.bin file.'''
     with open(filename, 'rb') as f:
         f.seek(0xE8)
         data_length = int.from_bytes(f.read(2), byteorder='little', signed=False)
@@ -87,31 +189,58 @@ def get_ekg(filename, do_bandpass_filter=True, filter_lowcut=30, filter_highcut=
         number_channels_hs = int.from_bytes(f.read(2), byteorder='little', signed=False) # heart sound
         number_channels = number_channels_ekg + number_channels_hs
 
-        data = [ list() for _ in range(number_channels) ]
+        f.seek(0, 2) # to the end of file
+        file_size = f.tell()
 
-        # data start
-        f.seek(0x4B8)
-        for index_cycle in range(data_length):
-            raw = f.read(2 * number_channels)
-            if len(raw) < 2 * number_channels:
-                break
-            for index_channel in range(number_channels):
-                data[index_channel].append(int.from_bytes(
-                raw[index_channel*2: (index_channel+1)*2],
-                byteorder='little', signed=True))
+    # drop the incomplete cycle if any
+    data_length = min(data_length, max(0, file_size - 0x4B8) // (2 * number_channels)) if number_channels else 0
+    return number_channels_ekg, number_channels_hs, data_length
+
+def get_ekg(filename, do_bandpass_filter=True, filter_lowcut=30, filter_highcut=100, native_dtype=False, use_cache=True,
+            progress=None):
+    '''Read an Audicor *.bin EKG file.
+
+    args:
+        native_dtype: return the samples as stored (int16) instead of int64
+        use_cache: read from the columnar cache (see cache.py) if it exists and is fresh
+        progress: called as progress(bytes decoded, total bytes) while the samples are decoded
+    '''
+    cached = cache.read_header(filename) if use_cache else None
+    if cached is not None:
+        number_channels_ekg, number_channels_hs = cached['number_channels_ekg'], cached['number_channels_hs']
+        number_channels = number_channels_ekg + number_channels_hs
+        samples = cache.load_channels(filename, range(number_channels))
+        data = _stack_channels(samples, np.int16 if native_dtype else np.int64, progress)
+    else:
+        number_channels_ekg, number_channels_hs, data_length = _read_ekg_header(filename)
+        number_channels = number_channels_ekg + number_channels_hs
 
-    data = np.array(data)
+        # data start at 0x4B8, interleaved as [cycle, channel]
+        samples = _memmap_samples(filename, 0x4B8, np.dtype('<i2'), (data_length, number_channels))
+        data = np.empty((number_channels, data_length), dtype=np.int16 if native_dtype else np.int64) # (channels, samples)
+        chunk_cycles = max(1, COPY_CHUNK_SAMPLES // max(1, number_channels))
+        for start in range(0, data_length, chunk_cycles):
+            end = min(data_length, start + chunk_cycles)
+            data[:, start:end] = samples[start:end].T
+            if progress is not None:
+                progress(samples[:end].nbytes, samples.nbytes)
 
     hs_data = data[number_channels_ekg: number_channels_ekg+number_channels_hs]
-    if do_bandpass_filter: hs_data = denoise.heart_sound_denoise(hs_data, filter_lowcut, filter_highcut, 1000)
+    if do_bandpass_filter: hs_data = _import_denoise().heart_sound_denoise(hs_data, filter_lowcut, filter_highcut, 1000)
     return data, [1000.]*number_channels # sampling rates
 
-def get_heart_sounds(filename, start_s=0, end_s=np.inf, verbose=True):
+RawHeader = collections.namedtuple('RawHeader', [
+    'number_channels', 'main_sampling_rate', 'channel_sampling_rate',
+    'index_order', 'number_value_per_cycle', 'index_value_per_cycle', 'channel_layout',
+    'file_size', 'number_cycles', 'total_time_in_sec'])
+
+def _read_raw_header(filename):
+    '''Parse the header of a *.raw file and compute its interleave cycle.'''
     with open(filename, 'rb') as f:
         # reading header
         f.read(0x24) # padding
         number_channels = int.from_bytes(f.read(0x1), byteorder='little')
-        while f.read(0x1) != b'\x0F': pass
+        while f.read(0x1) not in (b'\x0F', b''): pass # b'' at the end of a truncated header
         main_sampling_rate = float(f.read(0x10)[:0xF].decode('utf-8'))
         channel_sampling_rate = [ float(f.read(0x10)[:0xF].decode('utf-8')) for _ in range(number_channels) ]
 
@@ -135,40 +264,365 @@ def get_heart_sounds(filename, start_s=0, end_s=np.inf, verbose=True):
         number_cycles = (file_size - 512) // 2 // len(index_order)
         total_time_in_sec = number_cycles * index_order.count(0) / channel_sampling_rate[0]
 
-        if verbose: # print out info
-            print('='*37, 'INFO', '='*37)
-            print('number of channels:', number_channels)
-            print('main sampling rate:', main_sampling_rate)
-            for index_channel in range(number_channels):
-                print('sampling rate-'+str(index_channel)+':', channel_sampling_rate[index_channel])
-            print('channel reading order:', index_order)
-            print('total time:', str(datetime.timedelta(seconds=int(total_time_in_sec))))
-            print('='*80)
-            print('reading... ETA: {:.1f}s'.format(file_size / 1000 / 1000 / 17))
-
-        # reading raw file
-        f.seek(0x200) # 512
-        values = np.frombuffer(f.read(0x2 * number_cycles * len(index_order)), dtype=np.uint16)
-        channel_signals = [ np.ndarray([number_cycles * number_value_per_cycle[i]]) for i in range(number_channels) ]
-        for index_channel in range(number_channels):
-            for index_value in range(number_value_per_cycle[index_channel]):
-                channel_signals[index_channel][index_value::number_value_per_cycle[index_channel]] = values[index_value_per_cycle[index_channel][index_value]::len(index_order)]
-        # convert to numpy array
-        channel_signals = np.array(channel_signals)
+    channel_layout = [ _value_layout(index_value) for index_value in index_value_per_cycle ]
+    return RawHeader(number_channels, main_sampling_rate, channel_sampling_rate,
+                        index_order, number_value_per_cycle, index_value_per_cycle, channel_layout,
+                        file_size, number_cycles, total_time_in_sec)
+
+def get_raw_header(filename, use_cache=True):
+    '''Return the RawHeader of a *.raw file without reading its samples.'''
+    cached = cache.read_header(filename) if use_cache else None
+    return _read_raw_header(filename) if cached is None else _raw_header_from_cache(cached)
+
+def get_channel_lengths(header):
+    '''Return the number of samples of each channel of a *.raw file, as read by get_heart_sounds.'''
+    return [ min(int(sr * header.total_time_in_sec), header.number_cycles * number_value)
+                for sr, number_value in zip(header.channel_sampling_rate, header.number_value_per_cycle) ]
+
+def _raw_header_from_cache(cached):
+    fields = { name: cached[name] for name in RawHeader._fields if name != 'channel_layout' }
+    fields['channel_layout'] = [ _value_layout(index_value) for index_value in fields['index_value_per_cycle'] ]
+    return RawHeader(**fields)
+
+def _value_layout(index_value):
+    '''Turn the positions of a channel in a cycle into an index selecting its column(s).
+
+    A single position gives an int (a strided view), evenly spaced positions give a slice,
+    anything else an index array (a single gather).
+    '''
+    if len(index_value) == 1:
+        return index_value[0]
+    steps = set(np.diff(index_value))
+    if len(steps) == 1:
+        return slice(index_value[0], index_value[-1]+1, int(steps.pop()))
+    return np.array(index_value)
+
+def _cycle_range(header, start_s, end_s):
+    '''Return the [start, end) interleave cycles covering start_s to end_s.'''
+    cycle_duration = header.number_value_per_cycle[0] / header.channel_sampling_rate[0] # in seconds
+    start_cycle = min(header.number_cycles, int(start_s // cycle_duration))
+    end_cycle = min(header.number_cycles, int(np.ceil(end_s / cycle_duration)))
+    return start_cycle, max(start_cycle, end_cycle)
+
+def _memmap_cycles(filename, header, start_cycle, end_cycle):
+    '''Map the interleaved values of cycles [start_cycle, end_cycle) as a (cycles, values per cycle) array.'''
+    cycle_length = len(header.index_order)
+    return _memmap_samples(filename, 0x200 + 0x2 * cycle_length * start_cycle, # data start at 512
+                            np.dtype('<u2'), (end_cycle - start_cycle, cycle_length))
+
+# samples copied at once by the readers, between two progress reports
+COPY_CHUNK_SAMPLES = 2**22
+
+def _stack_channels(channel_signals, dtype, progress=None):
+    '''Copy channels into a 2-D array of dtype, or an object array if their lengths differ.
+
+    progress: called as progress(bytes read, total bytes) as the channels are copied
+    '''
+    ragged = len(set(len(signal) for signal in channel_signals)) > 1
+    if ragged:
+        stacked = np.empty(len(channel_signals), dtype=object)
+    else:
+        stacked = np.empty((len(channel_signals), len(channel_signals[0]) if channel_signals else 0), dtype=dtype)
+
+    total_bytes = sum(signal.nbytes for signal in channel_signals)
+    done_bytes = 0
+    for index_channel, signal in enumerate(channel_signals):
+        target = np.empty(len(signal), dtype=dtype) if ragged else stacked[index_channel]
+        for start in range(0, len(signal), COPY_CHUNK_SAMPLES):
+            chunk = signal[start: start+COPY_CHUNK_SAMPLES]
+            target[start: start+len(chunk)] = chunk
+            done_bytes += chunk.nbytes
+            if progress is not None:
+                progress(done_bytes, total_bytes)
+        if ragged:
+            stacked[index_channel] = target
+    return stacked
+
+def _resolve_channels(header, channels):
+    return list(range(header.number_channels)) if channels is None else list(channels)
+
+def get_heart_sounds(filename, start_s=0, end_s=np.inf, verbose=True, channels=None, native_dtype=False, use_cache=True,
+                        progress=None):
+    '''Read an Audicor *.raw heart sound file.
+
+    args:
+        channels: indices of the channels to read (default: all)
+        native_dtype: return the samples as stored (uint16) instead of float64
+        use_cache: read from the columnar cache (see cache.py) if it exists and is fresh
+        progress: called as progress(bytes read, total bytes) while the samples are read,
+            if verbose and not given, the measured throughput and ETA are printed
+    '''
+    cached = cache.read_header(filename) if use_cache else None
+    header = _read_raw_header(filename) if cached is None else _raw_header_from_cache(cached)
+    number_channels = header.number_channels
+    channels = _resolve_channels(header, channels)
+    channel_sampling_rate = [ header.channel_sampling_rate[i] for i in channels ]
+
+    if verbose: # print out info
+        print_raw_info(header)
+
+    # only read the cycles from start_s to end_s
+    end_s = min(end_s, header.total_time_in_sec)
+    if end_s <= start_s:
+        start_s, end_s = 0, header.total_time_in_sec
+
+    if verbose and progress is None:
+        progress = profiling.ProgressPrinter('reading')
+
+    # convert to numpy array
+    channel_signals = _read_window(filename, header, start_s, end_s, channels, cached is not None)
+    return _stack_channels(channel_signals, np.uint16 if native_dtype else np.float64, progress), channel_sampling_rate
+
+def print_raw_info(header):
+    print('='*37, 'INFO', '='*37)
+    print('number of channels:', header.number_channels)
+    print('main sampling rate:', header.main_sampling_rate)
+    for index_channel in range(header.number_channels):
+        print('sampling rate-'+str(index_channel)+':', header.channel_sampling_rate[index_channel])
+    print('channel reading order:', header.index_order)
+    print('total time:', str(datetime.timedelta(seconds=int(header.total_time_in_sec))))
+    print('='*80)
+
+def print_ekg_info(filename):
+    number_channels_ekg, number_channels_hs, data_length = _read_ekg_header(filename)
+    print('='*37, 'INFO', '='*37)
+    print('number of channels:', number_channels_ekg + number_channels_hs)
+    print('number of ekg channels:', number_channels_ekg)
+    print('number of heart sound channels:', number_channels_hs)
+    print('sampling rate:', 1000.)
+    print('number of samples:', data_length)
+    print('total time:', str(datetime.timedelta(seconds=data_length / 1000.)))
+    print('='*80)
+
+def print_info(filename):
+    '''Print the info of a *.bin or *.raw file, only reading its header.'''
+    print(filename)
+    if recording_format(filename) == 'bin': # EKG
+        print_ekg_info(filename)
+    elif recording_format(filename) == 'raw': # Heart Sound
+        print_raw_info(get_raw_header(filename))
+    else:
+        print('ERROR: filename must be *.bin or *.raw.')
+
+def _read_window(filename, header, start_s, end_s, channels, from_cache=False):
+    '''De-interleave the samples from start_s to end_s of the given channels.
+
+    Returns a list of uint16 arrays that are views of the file (or one gather per channel
+    for channels with several values per cycle), nothing is copied for the other channels.
+    '''
+    if from_cache:
+        return [ signal[int(header.channel_sampling_rate[i] * start_s): int(header.channel_sampling_rate[i] * end_s)]
+                    for i, signal in zip(channels, cache.load_channels(filename, channels)) ]
+
+    start_cycle, end_cycle = _cycle_range(header, start_s, end_s)
+
+    # reading raw file
+    values = _memmap_cycles(filename, header, start_cycle, end_cycle)
+    channel_signals = list()
+    for index_channel in channels:
+        number_value = header.number_value_per_cycle[index_channel]
+        signal = values[:, header.channel_layout[index_channel]].reshape(-1)
 
         # cut from start_s to end_s
-        end_s = min(end_s, total_time_in_sec)
-        if end_s > start_s:
-            for index_channel in range(number_channels):
-                start_index = int(channel_sampling_rate[index_channel] * start_s)
-                end_index = int(channel_sampling_rate[index_channel] * end_s)
-                channel_signals[index_channel] = channel_signals[index_channel][start_index:end_index]
+        sampling_rate = header.channel_sampling_rate[index_channel]
+        start_index = max(0, int(sampling_rate * start_s) - start_cycle * number_value)
+        end_index = int(sampling_rate * end_s) - start_cycle * number_value
+        channel_signals.append(signal[start_index:end_index])
+    return channel_signals
+
+def iter_heart_sounds(filename, block_s=60, overlap_s=0, start_s=0, end_s=np.inf, channels=None, native_dtype=False, use_cache=True,
+                        progress=None, header=None):
+    '''Iterate over a *.raw file block by block with bounded memory.
+
+    Blocks are block_s seconds long and consecutive blocks share overlap_s seconds.
+    progress is called as progress(bytes read, total bytes) after every block, the samples
+    shared by consecutive blocks are only counted once.
+    header: RawHeader to read the file with (default: read it), e.g. to read only the cycles
+    of a file still being written that were there when its header was read
+
+    yields:
+        sample_offsets: list of the index of the first sample of the block in each channel
+        channel_signals: list of np.ndarray, one per channel
+    '''
+    if not 0 <= overlap_s < block_s:
+        raise ValueError('overlap_s must be in [0, block_s), got {} with block_s={}'.format(overlap_s, block_s))
+
+    cached = cache.read_header(filename) if use_cache else None
+    if header is None:
+        header = _read_raw_header(filename) if cached is None else _raw_header_from_cache(cached)
+    channels = _resolve_channels(header, channels)
+    dtype = np.uint16 if native_dtype else np.float64
+    end_s = min(end_s, header.total_time_in_sec)
+    channel_lengths = get_channel_lengths(header)
+    first_offsets = [ int(header.channel_sampling_rate[i] * start_s) for i in channels ]
+    last_offsets = [ min(channel_lengths[i], int(header.channel_sampling_rate[i] * end_s)) for i in channels ]
+    total_bytes = 0x2 * sum(max(0, last - first) for first, last in zip(first_offsets, last_offsets))
+
+    index_block = 0
+    while True:
+        block_start_s = start_s + index_block * (block_s - overlap_s)
+        if block_start_s >= end_s or (index_block > 0 and block_start_s + overlap_s >= end_s):
+            break
+        block_end_s = min(end_s, block_start_s + block_s)
+
+        sample_offsets = [ int(header.channel_sampling_rate[i] * block_start_s) for i in channels ]
+        channel_signals = _read_window(filename, header, block_start_s, block_end_s, channels, cached is not None)
+        channel_signals = [ np.array(signal, dtype=dtype) for signal in channel_signals ]
+        if progress is not None:
+            done_bytes = 0x2 * sum(offset + len(signal) - first for offset, signal, first in zip(
+                                        sample_offsets, channel_signals, first_offsets))
+            progress(min(done_bytes, total_bytes), total_bytes)
+        yield sample_offsets, channel_signals
+        index_block += 1
+
+class RawTail:
+    '''Read the samples appended to a *.raw file that is still being written.
+
+    Only the complete interleave cycles are decoded; the next read_new() call starts
+    from the first cycle not decoded yet, so every call costs O(new bytes).
+
+    args:
+        start_cycle: first cycle to read (default: 0, the start of the file), e.g. the
+            number_cycles of a header to only read what comes after it
+    '''
+    def __init__(self, filename, channels=None, native_dtype=False, start_cycle=0):
+        if os.path.getsize(filename) < 0x200:
+            raise ValueError('the header of {} is not complete yet'.format(filename))
+        self.filename = filename
+        self.header = _read_raw_header(filename)
+        self.channels = _resolve_channels(self.header, channels)
+        self.dtype = np.uint16 if native_dtype else np.float64
+        self.next_cycle = int(start_cycle)
+
+    @property
+    def sample_offsets(self):
+        '''Index of the next sample of each channel.'''
+        return [ self.next_cycle * self.header.number_value_per_cycle[i] for i in self.channels ]
+
+    @property
+    def time_in_sec(self):
+        '''Time decoded so far.'''
+        return self.next_cycle * self.header.number_value_per_cycle[0] / self.header.channel_sampling_rate[0]
+
+    def read_new(self):
+        '''Return (sample_offsets, channel_signals) of the cycles appended since the last call.
+
+        channel_signals are empty if nothing was appended, or if the file got shorter.
+        '''
+        sample_offsets = self.sample_offsets
+        number_cycles = max(0, os.path.getsize(self.filename) - 0x200) // 0x2 // len(self.header.index_order)
+        if number_cycles <= self.next_cycle:
+            return sample_offsets, [ np.zeros(0, dtype=self.dtype) for _ in self.channels ]
+
+        values = _memmap_cycles(self.filename, self.header, self.next_cycle, number_cycles)
+        channel_signals = [ np.array(values[:, self.header.channel_layout[i]].reshape(-1), dtype=self.dtype)
+                                for i in self.channels ]
+        self.next_cycle = number_cycles
+        return sample_offsets, channel_signals
+
+def follow_heart_sounds(filename, interval_s=1., idle_timeout_s=None, channels=None, native_dtype=False, start_cycle=0):
+    '''Yield the samples of a *.raw file as they are appended, like `tail -f`.
+
+    The file is polled every interval_s seconds, also while its header is not written
+    yet, and the iteration stops after idle_timeout_s seconds without new samples
+    (default: never).
+
+    yields:
+        sample_offsets: list of the index of the first new sample in each channel
+        channel_signals: list of np.ndarray, the new samples of each channel
+    '''
+    tail = None
+    last_data = time.time()
+    while True:
+        if tail is None and os.path.exists(filename) and os.path.getsize(filename) >= 0x200:
+            tail = RawTail(filename, channels, native_dtype, start_cycle)
+
+        if tail is not None:
+            sample_offsets, channel_signals = tail.read_new()
+            if any(len(signal) for signal in channel_signals):
+                last_data = time.time()
+                yield sample_offsets, channel_signals
+                continue
+
+        if idle_timeout_s is not None and time.time() - last_data > idle_timeout_s:
+            return
+        time.sleep(interval_s)
+
+def load_recording(filename, start_s=0, end_s=np.inf, channels=None, use_cache=True, progress=None):
+    '''Read a *.bin or *.raw file into a Recording (see recording.py), each channel in its native dtype.
+
+    Channels read from a fresh columnar cache are memory-mapped, otherwise they are decoded into
+    contiguous int16 (*.bin) or uint16 (*.raw) arrays. The heart sounds of *.bin files are not filtered.
+
+    args:
+        start_s, end_s: window to read, in seconds
+        channels: indices of the channels to read (default: all)
+        progress: called as progress(bytes decoded, total bytes)
+    '''
+    cached = cache.read_header(filename) if use_cache else None
+    if recording_format(filename) == 'bin': # EKG
+        if cached is not None:
+            signals = cache.load_channels(filename, range(cached['number_channels_ekg'] + cached['number_channels_hs']))
+        else:
+            signals = list(get_ekg(filename, do_bandpass_filter=False, native_dtype=True, use_cache=False, progress=progress)[0])
+        recording = Recording(signals, [1000.] * len(signals))
+        if channels is not None:
+            recording = recording.select(channels)
+        return recording.slice(start_s, end_s)
+
+    elif recording_format(filename) == 'raw': # Heart Sound
+        header = _read_raw_header(filename) if cached is None else _raw_header_from_cache(cached)
+        channels = _resolve_channels(header, channels)
+        end_s = min(end_s, header.total_time_in_sec)
+        start_s = min(start_s, end_s)
+
+        channel_signals = _read_window(filename, header, start_s, end_s, channels, cached is not None)
+        if cached is None: # views of the interleaved file
+            channel_signals = list(_stack_channels(channel_signals, np.uint16, progress))
+        return Recording(channel_signals, [ header.channel_sampling_rate[i] for i in channels ], start_s=start_s)
+
+    raise ValueError('filename must be *.bin or *.raw, got {}'.format(filename))
+
+def convert_to_cache(filename, block_s=600, progress=None):
+    '''Decode filename once into its columnar cache (see cache.py) and return the cache directory.
+
+    progress: called as progress(bytes decoded, total bytes)
+    '''
+    if recording_format(filename) == 'bin': # EKG
+        data, _ = get_ekg(filename, do_bandpass_filter=False, native_dtype=True, use_cache=False, progress=progress)
+        number_channels_ekg, number_channels_hs, _ = _read_ekg_header(filename)
+        channel_arrays = cache.create_channels(filename, [data.shape[1]] * data.shape[0], np.int16)
+        for array, signal in zip(channel_arrays, data):
+            array[:] = signal
+        cache.commit(filename, channel_arrays, format='bin',
+                        number_channels_ekg=number_channels_ekg, number_channels_hs=number_channels_hs,
+                        sampling_rates=[1000.] * data.shape[0], total_time_in_sec=data.shape[1] / 1000.)
+
+    elif recording_format(filename) == 'raw': # Heart Sound
+        header = _read_raw_header(filename)
+        channel_arrays = cache.create_channels(filename, get_channel_lengths(header), np.uint16)
+        for sample_offsets, channel_signals in iter_heart_sounds(filename, block_s=block_s, native_dtype=True, use_cache=False,
+                                                                    progress=progress):
+            for array, offset, signal in zip(channel_arrays, sample_offsets, channel_signals):
+                array[offset: offset+len(signal)] = signal
+
+        info = { name: value for name, value in header._asdict().items() if name != 'channel_layout' }
+        cache.commit(filename, channel_arrays, format='raw', sampling_rates=header.channel_sampling_rate, **info)
 
-        return channel_signals, channel_sampling_rate
+    else:
+        raise ValueError('filename must be *.bin or *.raw, got {}'.format(filename))
+
+    return cache.cache_dirname(filename)
 
 def convert_time_to_sec(time_string='0:0:0'):
-    x = time.strptime(time_string,'%H:%M:%S')
-    return datetime.timedelta(hours=x.tm_hour,minutes=x.tm_min,seconds=x.tm_sec).total_seconds()
+    '''Convert H:M:S to seconds, hours can exceed 23 for recordings of several days.'''
+    fields = time_string.split(':')
+    if len(fields) != 3 or not all(field.strip().isdigit() for field in fields):
+        raise ValueError('time must be H:M:S, got {!r}'.format(time_string))
+    hours, minutes, seconds = [ int(field) for field in fields ]
+    if minutes > 59 or seconds > 59:
+        raise ValueError('minutes and seconds must be below 60, got {!r}'.format(time_string))
+    return datetime.timedelta(hours=hours, minutes=minutes, seconds=seconds).total_seconds()
 
 def generate_filenames(parse_args):
     raw_data_filename = os.path.basename(parse_args.filename)
@@ -182,9 +636,231 @@ def generate_filenames(parse_args):
 
     return raw_data_filename, spectrogram_filename
 
+SPECTROGRAM_MAX_COLUMNS = 4000
+
+def process_file(args):
+    '''Produce the figures of args.filename and return the filenames written.'''
+    if args.convert_cache:
+        print('Convert {} to {}!'.format(args.filename, cache.cache_dirname(args.filename)))
+        with profiling.span('convert_cache', filename=args.filename, bytes=os.path.getsize(args.filename)):
+            return [convert_to_cache(args.filename, progress=profiling.ProgressPrinter('converting'))]
+
+    denoise = _import_denoise()
+
+    # generate filenames
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    raw_data_filename, spectrogram_filename = [ os.path.join(args.output_dir, name) for name in generate_filenames(args) ]
+    print('Save to {} & {}!'.format(raw_data_filename, spectrogram_filename))
+    outputs = list()
+
+    figsize = (int(args.size_x), int(args.size_y))
+    if recording_format(args.filename) == 'bin': # EKG
+        peak_indices, segment_indices = None, None
+        with profiling.span('decode', filename=args.filename, bytes=os.path.getsize(args.filename)) as info:
+            ekg_raw, sampling_rates = get_ekg(args.filename)
+            info['samples'] = ekg_raw.size
+        if args.do_denoise:
+            with profiling.span('denoise', samples=ekg_raw[:8].size):
+                ekg_raw = denoise.denoise(ekg_raw, 1000, number_channels=8) # NOTE: fixed channel number
+        if args.do_segment:
+            import ecgseg
+            with profiling.span('segment', samples=ekg_raw[:8].size):
+                ekg_signal = ekg_raw if args.do_denoise else denoise.denoise(ekg_raw, 1000, number_channels=8)
+                peak_indices, segment_indices = ecgseg.predict('./2000-0.75.h5', ekg_signal)
+
+        with profiling.span('spectrogram', samples=ekg_raw.size):
+            ekg_spectrograms = generate_spectrogram(ekg_raw, sampling_rates)
+        with profiling.span('savefig', figure=raw_data_filename):
+            save_fig(raw_data_filename, ekg_raw, grid=True, peak_indices=peak_indices, segment_indices=segment_indices, figsize=figsize)
+        with profiling.span('savefig', figure=spectrogram_filename):
+            save_spectrogram_fig(spectrogram_filename, ekg_spectrograms, figsize=figsize)
+        outputs += [raw_data_filename, spectrogram_filename]
+
+    elif recording_format(args.filename) == 'raw': # Heart Sound
+        if args.do_segment:
+            print('''--segment option is ignored, since it's specified for EKGs.''')
+
+        start_s = convert_time_to_sec(args.start_time) if args.start_time else 0
+        end_s = convert_time_to_sec(args.end_time) if args.end_time else np.inf
+
+        with profiling.span('decode', filename=args.filename) as info:
+            heart_sounds, sampling_rates = get_heart_sounds(args.filename, start_s, end_s)
+            info['samples'] = sum(len(signal) for signal in heart_sounds)
+            info['bytes'] = 0x2 * info['samples']
+
+        if args.do_denoise: # NOTE: this may only work with 6-channel .raw file
+            if heart_sounds.shape[0] != 6:
+                print('Warning: --denoise option may only work with 6-channel .raw files, while {:d}-channel signal is given!'.format(heart_sounds.shape[0]))
+
+            with profiling.span('denoise', samples=len(heart_sounds[0]) + len(heart_sounds[1])):
+                heart_sounds[0:1] = denoise.heart_sound_denoise(heart_sounds[0:1], 30, 100, sampling_rates[0])# heart sound
+                heart_sounds[1] = denoise.denoise(heart_sounds[1][np.newaxis, ...], sampling_rates[1], number_channels=1)[0] # EKG
+
+        with profiling.span('savefig', figure=raw_data_filename):
+            save_fig(raw_data_filename, heart_sounds, figsize=figsize)
+        outputs.append(raw_data_filename)
+
+        # average long spectrograms over time to about the number of columns the figure can show
+        duration_s = len(heart_sounds[0]) / sampling_rates[0]
+        time_resolution_s = None
+        if duration_s > 60 and not args.force_spectrogram:
+            time_resolution_s = duration_s / SPECTROGRAM_MAX_COLUMNS
+        with profiling.span('spectrogram', samples=sum(len(signal) for signal in heart_sounds)):
+            heart_sounds_spectrograms = generate_spectrogram(heart_sounds, sampling_rates, time_resolution_s=time_resolution_s)
+        with profiling.span('savefig', figure=spectrogram_filename):
+            save_spectrogram_fig(spectrogram_filename, heart_sounds_spectrograms, figsize=figsize)
+        outputs.append(spectrogram_filename)
+
+    else:
+        print('ERROR: filename must be *.bin or *.raw.')
+
+    _import_pyplot()[1].close('all')
+    return outputs
+
+def collect_filenames(patterns):
+    '''Expand directories (recursively) and glob patterns into a sorted list of *.bin and *.raw files.'''
+    filenames = list()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, _, files in os.walk(pattern):
+                filenames += [ os.path.join(root, f) for f in files if recording_format(f) is not None ]
+        elif glob.has_magic(pattern):
+            filenames += [ f for f in glob.glob(pattern, recursive=True) if os.path.isfile(f) ]
+        else:
+            filenames.append(pattern)
+    return sorted(set(filenames))
+
+# options which change the produced figures
+MANIFEST_OPTIONS = ['size_x', 'size_y', 'start_time', 'end_time', 'force_spectrogram', 'do_denoise', 'do_segment', 'output_dir', 'convert_cache']
+
+def _manifest_entry(args):
+    stat = os.stat(args.filename)
+    return {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'options': { name: getattr(args, name) for name in MANIFEST_OPTIONS },
+    }
+
+def load_manifest(filename):
+    if filename is None or not os.path.exists(filename):
+        return dict()
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+# the manifest is rewritten at most this often, and once at the end of the batch
+MANIFEST_SAVE_INTERVAL_S = 30
+
+def save_manifest(filename, manifest):
+    # write to a temporary file first so that an interrupted run never leaves a broken manifest
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(filename + '.tmp', filename)
+
+def is_up_to_date(manifest, args):
+    record = manifest.get(os.path.abspath(args.filename))
+    if record is None:
+        return False
+    entry = _manifest_entry(args)
+    return (all(record.get(key) == value for key, value in entry.items())
+                and all(os.path.exists(output) for output in record['outputs']))
+
+def _process_file_safe(args):
+    '''Process a file and return (args, outputs, error, profiled spans), in a worker or not.'''
+    profiler = profiling.enable() if args.profile else None
+    try:
+        with profiling.span('process_file', filename=args.filename):
+            outputs, error = process_file(args), None
+    except Exception as e:
+        outputs, error = [], '{}: {}'.format(type(e).__name__, e)
+    return args, outputs, error, profiler.pop_events() if profiler is not None else []
+
+def _output_dirs(filenames, output_dir):
+    '''Mirror the directories of filenames, relative to their common directory, under output_dir,
+    so that files of the same name in different directories do not write to the same figures.'''
+    dirnames = [ os.path.dirname(os.path.abspath(filename)) for filename in filenames ]
+    try:
+        root = os.path.commonpath(dirnames) if dirnames else None
+    except ValueError: # on different drives
+        root = None
+    if root is None:
+        return [ os.path.join(output_dir, os.path.splitdrive(dirname)[1].lstrip(os.sep)) for dirname in dirnames ]
+    return [ os.path.normpath(os.path.join(output_dir, os.path.relpath(dirname, root))) if dirname != root else output_dir
+                for dirname in dirnames ]
+
+def _init_batch_worker(max_denoise_workers):
+    _import_denoise().set_max_workers(max_denoise_workers)
+
+def run_batch(args):
+    '''Process every file matched by args.filenames, in a pool of args.jobs processes.'''
+    filenames = collect_filenames(args.filenames)
+    if args.info: # header only, nothing is written
+        for filename in filenames:
+            print_info(filename)
+        return 0
+
+    profiler = profiling.enable() if args.profile else None
+    manifest = load_manifest(args.manifest)
+    jobs = list()
+    for filename, output_dir in zip(filenames, _output_dirs(filenames, args.output_dir)):
+        file_args = argparse.Namespace(**vars(args))
+        file_args.filename = filename
+        file_args.output_dir = output_dir
+        if is_up_to_date(manifest, file_args):
+            print('Skip {}, already up to date.'.format(filename))
+            continue
+        jobs.append(file_args)
+
+    if args.jobs > 1 and len(jobs) > 1:
+        # unlike mp.Pool, the workers are not daemonic so denoise can still start its own pool,
+        # sized to their share of the CPUs
+        number_workers = min(args.jobs, len(jobs))
+        workers = ProcessPoolExecutor(max_workers=number_workers, initializer=_init_batch_worker,
+                                        initargs=(max(1, (os.cpu_count() or 1) // number_workers),))
+        results = as_completed([ workers.submit(_process_file_safe, file_args) for file_args in jobs ])
+        results = ( result.result() for result in results )
+    else:
+        workers = None
+        results = map(_process_file_safe, jobs)
+
+    number_failed = 0
+    manifest_changed, manifest_saved = False, time.time()
+    try:
+        for file_args, outputs, error, events in results:
+            if profiler is not None:
+                profiler.add_events(events)
+            if error is not None:
+                number_failed += 1
+                print('ERROR: failed to process {}: {}'.format(file_args.filename, error))
+                continue
+            if args.manifest:
+                entry = _manifest_entry(file_args)
+                entry['outputs'] = outputs
+                manifest[os.path.abspath(file_args.filename)] = entry
+                manifest_changed = True
+                # rewriting it after every file would be quadratic in the number of files
+                if time.time() - manifest_saved > MANIFEST_SAVE_INTERVAL_S:
+                    save_manifest(args.manifest, manifest)
+                    manifest_changed, manifest_saved = False, time.time()
+    finally:
+        if workers is not None:
+            workers.shutdown()
+        if manifest_changed:
+            save_manifest(args.manifest, manifest)
+
+    print('Done: {} processed, {} failed, {} skipped.'.format(len(jobs) - number_failed, number_failed, len(filenames) - len(jobs)))
+    if profiler is not None:
+        profiler.save(args.profile)
+        for name, stage in sorted(profiler.summary().items(), key=lambda item: -item[1]['total_s']):
+            peak_rss = '?' if stage['peak_rss_mb'] is None else '{:.0f}'.format(stage['peak_rss_mb'])
+            print('{:>16}: {:>4d} x, {:>9.3f}s, peak RSS {} MB'.format(name, stage['count'], stage['total_s'], peak_rss))
+        print('Profile saved to {}.'.format(args.profile))
+    return number_failed
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Produce ekg and heart_sound figure.')
-    parser.add_argument('filename', help='Filename to read. Must be *.bin or *.raw (case-insensitive).')
+    parser.add_argument('filenames', nargs='+', metavar='filename',
+                help='Filenames, directories or glob patterns to read. Must be *.bin or *.raw (case-insensitive).')
     parser.add_argument(
                 '-sx',
                 '--size-x',
@@ -214,7 +890,7 @@ if __name__ == '__main__':
     parser.add_argument(
                 '-fsg',
                 '--force-spectrogram',
-                help='Calculate spectrogram of which has the data length longer than 60s.',
+                help='Calculate spectrogram of data longer than 60s at full time resolution instead of averaging it over time.',
                 dest='force_spectrogram',
                 action='store_true'
                 )
@@ -235,50 +911,48 @@ if __name__ == '__main__':
                 action='store_true'
                 )
 
-    args = parser.parse_args()
-
-    # generate filenames
-    raw_data_filename, spectrogram_filename = generate_filenames(args)
-    print('Save to {} & {}!'.format(raw_data_filename, spectrogram_filename))
-
-    figsize = (int(args.size_x), int(args.size_y))
-    if re.search('.*.bin', args.filename, re.IGNORECASE): # EKG
-        peak_indices, segment_indices = None, None
-        ekg_raw, sampling_rates = get_ekg(args.filename)
-        if args.do_denoise:
-            ekg_raw = denoise.denoise(ekg_raw, 1000, number_channels=8) # NOTE: fixed channel number
-        if args.do_segment:
-            import ecgseg
-            ekg_signal = ekg_raw if args.do_denoise else denoise.denoise(ekg_raw, 1000, number_channels=8)
-            peak_indices, segment_indices = ecgseg.predict('./2000-0.75.h5', ekg_signal)
-
-        ekg_spectrograms = generate_spectrogram(ekg_raw, sampling_rates)
-        save_fig(raw_data_filename, ekg_raw, grid=True, peak_indices=peak_indices, segment_indices=segment_indices, figsize=figsize)
-        save_spectrogram_fig(spectrogram_filename, ekg_spectrograms, figsize=figsize)
-
-    elif re.search('.*.raw', args.filename, re.IGNORECASE): # Heart Sound
-        if args.do_segment:
-            print('''--segment option is ignored, since it's specified for EKGs.''')
-
-        start_s = convert_time_to_sec(args.start_time) if args.start_time else 0
-        end_s = convert_time_to_sec(args.end_time) if args.end_time else np.inf
+    parser.add_argument(
+                '-i',
+                '--info',
+                help='Only print the number of channels, sampling rates and total time of the files, reading their headers.',
+                dest='info',
+                action='store_true'
+                )
 
-        heart_sounds, sampling_rates = get_heart_sounds(args.filename, start_s, end_s)
+    parser.add_argument(
+                '-cv',
+                '--convert-cache',
+                help='Only decode the files into their columnar cache (*.cache directories) for fast loading later.',
+                dest='convert_cache',
+                action='store_true'
+                )
 
-        if args.do_denoise: # NOTE: this may only work with 6-channel .raw file
-            if heart_sounds.shape[0] != 6:
-                print('Warning: --denoise option may only work with 6-channel .raw files, while {:d}-channel signal is given!'.format(heart_sounds.shape[0]))
+    parser.add_argument(
+                '-o',
+                '--output-dir',
+                help='Directory to save figures to, the subdirectories of the input files are mirrored in it. (default: current directory)',
+                dest='output_dir',
+                default='')
 
-            heart_sounds[0:1] = denoise.heart_sound_denoise(heart_sounds[0:1], 30, 100, sampling_rates[0])# heart sound
-            heart_sounds[1] = denoise.denoise(heart_sounds[1][np.newaxis, ...], number_channels=1)[0] # EKG
+    parser.add_argument(
+                '-j',
+                '--jobs',
+                help='Number of files processed in parallel. (default: 1)',
+                dest='jobs',
+                type=int,
+                default=1)
 
-        save_fig(raw_data_filename, heart_sounds, figsize=figsize)
+    parser.add_argument(
+                '-m',
+                '--manifest',
+                help='JSON manifest of processed files, unchanged files listed in it are skipped.',
+                dest='manifest')
 
-        if end_s - start_s < 60 or args.force_spectrogram:
-            heart_sounds_spectrograms = generate_spectrogram(heart_sounds, sampling_rates)
-            save_spectrogram_fig(spectrogram_filename, heart_sounds_spectrograms, figsize=figsize)
-        else:
-            print('''The signal is too long, skipping the spectrogram! Use -fsg to bypass the check!''')
+    parser.add_argument(
+                '-p',
+                '--profile',
+                help='Write the time and memory of every stage to this JSON file, in the Chrome trace format.',
+                dest='profile')
 
-    else:
-        print('ERROR: filename must be *.bin or *.raw.')
+    args = parser.parse_args()
+    sys.exit(1 if run_batch(args) else 0)
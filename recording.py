@@ -0,0 +1,108 @@
+'''Recordings stored as one array per channel in its native dtype.
+
+A Recording keeps every channel at its own sampling rate and length (no padding, no
+object arrays) in the dtype it was stored in, int16 for *.bin and uint16 for *.raw
+files, and only converts it to floats when asked:
+
+    recording = reader.load_recording('some/file.raw')
+    window = recording.slice(3600, 3660) # views, nothing is copied
+    signal = window.get(0, np.float32) # (raw - offset) * gain, in float32
+    t = window.time(0) # in seconds from the start of the recording
+'''
+import numpy as np
+
+def _sample_index(seconds, sampling_rate):
+    # a little tolerance, so that e.g. 0.3 s - 0.1 s at 10 Hz is sample 2
+    return int(np.floor(seconds * sampling_rate + 1e-6))
+
+class Recording:
+    '''Channels of a recording, each with its sampling rate, gain and offset.
+
+    args:
+        signals: one 1-D array per channel, in its native dtype (memory maps are fine)
+        sampling_rates: sampling rate of each channel
+        gains, offsets: physical value = (raw value - offset) * gain (default: 1 and 0, the raw values)
+        start_s: time of the first sample of every channel, in seconds from the start of the recording
+    '''
+    def __init__(self, signals, sampling_rates, gains=None, offsets=None, start_s=0.):
+        if len(signals) != len(sampling_rates):
+            raise ValueError('got {} signals but {} sampling rates'.format(len(signals), len(sampling_rates)))
+        self.signals = [ np.asarray(signal) for signal in signals ]
+        self.sampling_rates = [ float(rate) for rate in sampling_rates ]
+        self.gains = [1.] * len(signals) if gains is None else [ float(gain) for gain in gains ]
+        self.offsets = [0.] * len(signals) if offsets is None else [ float(offset) for offset in offsets ]
+        self.start_s = float(start_s)
+
+    @property
+    def number_channels(self):
+        return len(self.signals)
+
+    @property
+    def lengths(self):
+        return [ signal.shape[0] for signal in self.signals ]
+
+    @property
+    def dtypes(self):
+        return [ signal.dtype for signal in self.signals ]
+
+    @property
+    def duration_s(self):
+        return max([ len(signal) / rate for signal, rate in zip(self.signals, self.sampling_rates) ], default=0.)
+
+    @property
+    def nbytes(self):
+        return sum(signal.nbytes for signal in self.signals)
+
+    def __repr__(self):
+        return 'Recording({} channels, {:.1f}s from {:.1f}s, rates {}, dtypes {})'.format(
+                    self.number_channels, self.duration_s, self.start_s, self.sampling_rates,
+                    [ dtype.name for dtype in self.dtypes ])
+
+    def raw(self, index_channel):
+        '''Return the samples of a channel as stored.'''
+        return self.signals[index_channel]
+
+    def get(self, index_channel, dtype=np.float64):
+        '''Return a new array of the physical values of a channel, computed in dtype.'''
+        signal = self.signals[index_channel].astype(dtype)
+        if self.offsets[index_channel] != 0:
+            signal -= self.offsets[index_channel]
+        if self.gains[index_channel] != 1:
+            signal *= self.gains[index_channel]
+        return signal
+
+    def time(self, index_channel):
+        '''Return the time of every sample of a channel, in seconds.'''
+        return self.start_s + np.arange(len(self.signals[index_channel])) / self.sampling_rates[index_channel]
+
+    def to_arrays(self, dtype=np.float64):
+        '''Return the physical values of every channel, as a list of arrays of dtype.'''
+        return [ self.get(index_channel, dtype) for index_channel in range(self.number_channels) ]
+
+    def to_array(self, dtype=np.float64):
+        '''Return the physical values as a [n_channels, n_samples] array, if all channels have the same length.'''
+        if len(set(self.lengths)) > 1:
+            raise ValueError('channels have different lengths {}, use to_arrays instead'.format(self.lengths))
+        stacked = np.empty((self.number_channels, self.lengths[0] if self.signals else 0), dtype=dtype)
+        for index_channel in range(self.number_channels):
+            stacked[index_channel] = self.get(index_channel, dtype)
+        return stacked
+
+    def select(self, channels):
+        '''Return a Recording of the given channels, sharing their arrays.'''
+        channels = list(channels)
+        return Recording([ self.signals[i] for i in channels ], [ self.sampling_rates[i] for i in channels ],
+                            [ self.gains[i] for i in channels ], [ self.offsets[i] for i in channels ], self.start_s)
+
+    def slice(self, start_s=None, end_s=None):
+        '''Return the part of the recording from start_s to end_s (in seconds from the start
+        of the recording) as a Recording of views, nothing is copied.'''
+        start_s = self.start_s if start_s is None else max(float(start_s), self.start_s)
+        end_s = np.inf if end_s is None else float(end_s)
+
+        signals = list()
+        for signal, rate in zip(self.signals, self.sampling_rates):
+            start_index = min(len(signal), _sample_index(start_s - self.start_s, rate))
+            end_index = len(signal) if end_s == np.inf else min(len(signal), _sample_index(end_s - self.start_s, rate))
+            signals.append(signal[start_index: max(start_index, end_index)])
+        return Recording(signals, self.sampling_rates, self.gains, self.offsets, start_s)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+'''SQLite index of the headers of *.bin and *.raw recordings.
+
+Only the headers are parsed, in parallel, and files whose size and modification
+time did not change since the last update are not read again.
+
+    $ python3 recording_index.py update archive.sqlite /data/audicor -j 8
+    $ python3 recording_index.py select archive.sqlite --channels 6 --min-time 20:0:0
+'''
+import os
+import json
+import sqlite3
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from . import reader
+except:
+    import reader
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS recordings (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    format TEXT,
+    number_channels INTEGER,
+    number_channels_ekg INTEGER,
+    number_channels_hs INTEGER,
+    main_sampling_rate REAL,
+    sampling_rates TEXT,
+    number_cycles INTEGER,
+    total_time_in_sec REAL,
+    error TEXT
+)
+'''
+
+COLUMNS = ['path', 'size', 'mtime_ns', 'format', 'number_channels', 'number_channels_ekg', 'number_channels_hs',
+            'main_sampling_rate', 'sampling_rates', 'number_cycles', 'total_time_in_sec', 'error']
+
+def connect(database):
+    connection = sqlite3.connect(database)
+    connection.row_factory = sqlite3.Row
+    connection.execute(SCHEMA)
+    return connection
+
+def read_header_record(path):
+    '''Parse the header of a *.bin or *.raw file into a row of the index.
+
+    Errors (a missing file, a corrupted header) are recorded in the error column of the row.
+    '''
+    record = dict.fromkeys(COLUMNS)
+    record.update(path=path, size=-1, mtime_ns=-1) # parsed again by the next update if stat fails
+    try:
+        stat = os.stat(path)
+        record.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        if reader.recording_format(path) == 'bin': # EKG
+            number_channels_ekg, number_channels_hs, data_length = reader._read_ekg_header(path)
+            number_channels = number_channels_ekg + number_channels_hs
+            record.update(format='bin', number_channels=number_channels,
+                            number_channels_ekg=number_channels_ekg, number_channels_hs=number_channels_hs,
+                            main_sampling_rate=1000., sampling_rates=json.dumps([1000.] * number_channels),
+                            number_cycles=data_length, total_time_in_sec=data_length / 1000.)
+        elif reader.recording_format(path) == 'raw': # Heart Sound
+            header = reader.get_raw_header(path, use_cache=False)
+            record.update(format='raw', number_channels=header.number_channels,
+                            main_sampling_rate=header.main_sampling_rate,
+                            sampling_rates=json.dumps(header.channel_sampling_rate),
+                            number_cycles=header.number_cycles, total_time_in_sec=header.total_time_in_sec)
+        else:
+            record['error'] = 'filename must be *.bin or *.raw'
+    except Exception as e: # missing file or corrupted header
+        record['error'] = '{}: {}'.format(type(e).__name__, e)
+    return record
+
+def update_index(database, patterns, jobs=1, prune=True):
+    '''Index the files matched by patterns (see reader.collect_filenames) and return the number of files parsed.
+
+    prune: remove the files which do not exist anymore from the index
+    '''
+    filenames = [ os.path.abspath(filename) for filename in reader.collect_filenames(patterns) ]
+    connection = connect(database)
+    with connection: # commit at the end
+        indexed = { row['path']: (row['size'], row['mtime_ns'])
+                    for row in connection.execute('SELECT path, size, mtime_ns FROM recordings') }
+
+        outdated = list()
+        for filename in filenames:
+            try:
+                stat = os.stat(filename)
+            except OSError: # the error is recorded by read_header_record
+                outdated.append(filename)
+                continue
+            if indexed.get(filename) != (stat.st_size, stat.st_mtime_ns):
+                outdated.append(filename)
+
+        if jobs > 1 and len(outdated) > 1:
+            with ProcessPoolExecutor(max_workers=jobs) as workers:
+                records = list(workers.map(read_header_record, outdated, chunksize=64))
+        else:
+            records = [ read_header_record(filename) for filename in outdated ]
+
+        connection.executemany('INSERT OR REPLACE INTO recordings ({}) VALUES ({})'.format(
+                                    ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))),
+                                [ [ record[column] for column in COLUMNS ] for record in records ])
+
+        if prune:
+            missing = [ (path,) for path in indexed if not os.path.exists(path) ]
+            connection.executemany('DELETE FROM recordings WHERE path = ?', missing)
+    connection.close()
+
+    return len(records)
+
+def select(database, file_format=None, channels=None, min_channels=None, max_channels=None,
+            min_time_s=None, max_time_s=None, sampling_rate=None):
+    '''Return the rows (sqlite3.Row) of the index matching every given condition, ordered by path.
+
+    sampling_rate: only keep the recordings having a channel sampled at this rate
+    '''
+    conditions, parameters = ['error IS NULL'], list()
+    for condition, value in [ ('format = ?', file_format),
+                                ('number_channels = ?', channels),
+                                ('number_channels >= ?', min_channels),
+                                ('number_channels <= ?', max_channels),
+                                ('total_time_in_sec >= ?', min_time_s),
+                                ('total_time_in_sec <= ?', max_time_s) ]:
+        if value is not None:
+            conditions.append(condition)
+            parameters.append(value)
+
+    connection = connect(database)
+    rows = connection.execute('SELECT * FROM recordings WHERE {} ORDER BY path'.format(' AND '.join(conditions)),
+                                parameters).fetchall()
+    connection.close()
+    if sampling_rate is not None:
+        rows = [ row for row in rows if float(sampling_rate) in json.loads(row['sampling_rates']) ]
+    return rows
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index the headers of *.bin and *.raw recordings in a SQLite database.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    update_parser = subparsers.add_parser('update', help='Add new and modified files to the index.')
+    update_parser.add_argument('database', help='SQLite database of the index.')
+    update_parser.add_argument('patterns', nargs='+', metavar='filename',
+                                help='Filenames, directories or glob patterns to index.')
+    update_parser.add_argument('-j', '--jobs', help='Number of processes parsing headers. (default: 1)',
+                                dest='jobs', type=int, default=1)
+
+    select_parser = subparsers.add_parser('select', help='Print the paths of the indexed files matching all conditions.')
+    select_parser.add_argument('database', help='SQLite database of the index.')
+    select_parser.add_argument('--format', help='bin or raw.', dest='format', choices=['bin', 'raw'])
+    select_parser.add_argument('--channels', help='Number of channels.', dest='channels', type=int)
+    select_parser.add_argument('--min-channels', help='Minimum number of channels.', dest='min_channels', type=int)
+    select_parser.add_argument('--max-channels', help='Maximum number of channels.', dest='max_channels', type=int)
+    select_parser.add_argument('--min-time', help='Minimum total time, H:M:S.', dest='min_time')
+    select_parser.add_argument('--max-time', help='Maximum total time, H:M:S.', dest='max_time')
+    select_parser.add_argument('--sampling-rate', help='Sampling rate of at least one channel.', dest='sampling_rate', type=float)
+
+    args = parser.parse_args()
+    if args.command == 'update':
+        print('{} files parsed.'.format(update_index(args.database, args.patterns, args.jobs)))
+    else:
+        rows = select(args.database, file_format=args.format, channels=args.channels,
+                        min_channels=args.min_channels, max_channels=args.max_channels,
+                        min_time_s=reader.convert_time_to_sec(args.min_time) if args.min_time else None,
+                        max_time_s=reader.convert_time_to_sec(args.max_time) if args.max_time else None,
+                        sampling_rate=args.sampling_rate)
+        for row in rows:
+            print(row['path'])
@@ -0,0 +1,52 @@
+'''Band-limited, chunked spectrograms of long signals.
+
+Computes the same power spectral density as scipy.signal.spectrogram (tukey window,
+constant detrend, one-sided density), but only for the frequency bins up to fmax,
+a chunk of frames at a time, in float32, optionally averaged over time.
+'''
+import numpy as np
+
+def band_spectrogram(signal, fs, nperseg, noverlap, nfft, fmax=None, chunk_frames=65536, average_frames=1):
+    '''Return f, t, Sxx (float32, of shape [n_bins, n_frames]) of a 1-D signal.
+
+    args:
+        fmax: highest frequency to compute, the bins above it are skipped (default: fs/2)
+        chunk_frames: number of frames transformed at once, which bounds the memory used
+        average_frames: average every average_frames consecutive frames into one column
+    '''
+    from scipy.signal import get_window
+
+    signal = np.asarray(signal)
+    step = nperseg - noverlap
+    number_frames = (signal.shape[0] - noverlap) // step if signal.shape[0] >= nperseg else 0
+    average_frames = max(1, int(average_frames))
+
+    # direct DFT of the kept bins, much cheaper than an nfft-long FFT when few bins are kept
+    f = np.arange(nfft // 2 + 1) * fs / nfft
+    if fmax is not None:
+        f = f[: np.searchsorted(f, fmax, side='left') + 1] # up to the first bin >= fmax
+    window = get_window(('tukey', .25), nperseg)
+    transform = window[:, np.newaxis] * np.exp(-2j * np.pi * np.outer(np.arange(nperseg), np.arange(f.shape[0])) / nfft)
+
+    # one-sided density scaling
+    scale = np.full(f.shape[0], 2. / (fs * (window**2).sum()))
+    scale[0] /= 2
+    if nfft % 2 == 0 and f.shape[0] == nfft // 2 + 1: # Nyquist bin
+        scale[-1] /= 2
+
+    number_columns = number_frames // average_frames
+    Sxx = np.empty((f.shape[0], number_columns), dtype=np.float32)
+    chunk_frames = max(average_frames, chunk_frames // average_frames * average_frames)
+    for start_frame in range(0, number_columns * average_frames, chunk_frames):
+        end_frame = min(number_columns * average_frames, start_frame + chunk_frames)
+        samples = signal[start_frame * step: (end_frame - 1) * step + nperseg].astype(np.float64)
+        frames = np.lib.stride_tricks.sliding_window_view(samples, nperseg)[::step]
+        frames = frames - frames.mean(axis=1, keepdims=True) # constant detrend
+
+        power = np.abs(frames @ transform)**2 * scale
+        power = power.reshape(-1, average_frames, f.shape[0]).mean(axis=1)
+        Sxx[:, start_frame // average_frames: end_frame // average_frames] = power.T
+
+    # center of each (averaged) column
+    t = (np.arange(number_columns) * average_frames * step + ((average_frames - 1) * step + nperseg) / 2) / fs
+    return f, t, Sxx